@@ -0,0 +1,159 @@
+"""
+Time the aggregation step on synthetic outputs of the earlier steps.
+
+Run from scatter/pipeline:
+
+    python -m benchmarks.aggregation --sizes 10000 100000 1000000
+
+For every size, the script writes synthetic inputs/<name>.csv, args.csv,
+clusters.csv, labels.csv, takeaways.csv and overview.txt to a temporary
+directory and reports the wall time of `aggregation` and the size of the
+result.json it writes (and of result.json.gz with --gzip).
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from steps.aggregation import aggregation
+
+DATASET = "benchmark"
+
+
+def write_synthetic_outputs(root, n_arguments, n_clusters, seed=42):
+    rng = np.random.default_rng(seed)
+    # 1つのコメントから平均2件の意見が抽出される想定
+    n_comments = max(1, n_arguments // 2)
+    comment_ids = rng.integers(n_comments, size=n_arguments)
+    comment_ids.sort()
+    arg_index = pd.Series(comment_ids).groupby(comment_ids).cumcount().values
+    arg_ids = [f"A{c}_{j}" for c, j in zip(comment_ids, arg_index)]
+
+    comments = pd.DataFrame(
+        {
+            "comment-id": np.arange(n_comments),
+            "comment-body": [f"コメント本文 {i}" for i in range(n_comments)],
+            "source": rng.choice(["web", "form", "spam"], size=n_comments),
+        }
+    )
+    arguments = pd.DataFrame(
+        {
+            "arg-id": arg_ids,
+            "comment-id": comment_ids,
+            "argument": [f"意見 {arg_id}" for arg_id in arg_ids],
+            "source": comments["source"].values[comment_ids],
+            # 分類に失敗した意見は空欄になる
+            "topic": np.where(
+                rng.random(n_arguments) < 0.05,
+                None,
+                rng.choice(["環境", "教育", "経済"], size=n_arguments),
+            ),
+        }
+    )
+    clusters = pd.DataFrame(
+        {
+            "arg-id": arg_ids,
+            "x": rng.normal(size=n_arguments),
+            "y": rng.normal(size=n_arguments),
+            "probability": rng.random(n_arguments),
+            "cluster-id": rng.integers(n_clusters, size=n_arguments),
+        }
+    )
+    cluster_ids = np.arange(n_clusters)
+    # labelling はクラスタごとに5件の代表意見を選ぶ
+    representatives = clusters.groupby("cluster-id")["arg-id"].agg(
+        lambda ids: ",".join(ids.head(5))
+    )
+    labels = pd.DataFrame(
+        {
+            "cluster-id": cluster_ids,
+            "label": [f"ラベル {c}" for c in cluster_ids],
+            "representatives": representatives.reindex(cluster_ids).values,
+        }
+    )
+    takeaways = pd.DataFrame(
+        {"cluster-id": cluster_ids, "takeaways": [f"要約 {c}" for c in cluster_ids]}
+    )
+
+    output_dir = os.path.join(root, "outputs", DATASET)
+    os.makedirs(output_dir)
+    os.makedirs(os.path.join(root, "inputs"))
+    comments.to_csv(os.path.join(root, "inputs", f"{DATASET}.csv"), index=False)
+    arguments.to_csv(os.path.join(output_dir, "args.csv"), index=False)
+    clusters.to_csv(os.path.join(output_dir, "clusters.csv"), index=False)
+    labels.to_csv(os.path.join(output_dir, "labels.csv"), index=False)
+    takeaways.to_csv(os.path.join(output_dir, "takeaways.csv"), index=False)
+    with open(os.path.join(output_dir, "overview.txt"), "w") as f:
+        f.write("概要")
+
+
+def benchmark_config(n_arguments, sampling_num, compact=False, compression=()):
+    return {
+        "name": "benchmark",
+        "question": "質問",
+        "input": DATASET,
+        "output_dir": DATASET,
+        "intro": "ベンチマーク",
+        "extraction": {"limit": n_arguments, "categories": {"topic": {}}},
+        "aggregation": {
+            "sampling_num": sampling_num,
+            "hidden_properties": {"source": ["spam"]},
+            "include_minor": False,
+            "compact": compact,
+            "shards": False,
+            "compression": list(compression),
+        },
+    }
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--clusters", type=int, default=50)
+    parser.add_argument("--sampling-num", type=int, default=5000)
+    parser.add_argument("--compact", action="store_true")
+    parser.add_argument("--gzip", action="store_true")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    cwd = os.getcwd()
+    rows = []
+    for n in args.sizes:
+        root = tempfile.mkdtemp(prefix="aggregation-benchmark-")
+        try:
+            write_synthetic_outputs(root, n, args.clusters)
+            os.chdir(root)
+            compression = ["gzip"] if args.gzip else []
+            config = benchmark_config(
+                n, args.sampling_num, args.compact, compression
+            )
+            started = time.perf_counter()
+            aggregation(config)
+            seconds = time.perf_counter() - started
+            result_path = os.path.join("outputs", DATASET, "result.json")
+            row = {
+                "arguments": n,
+                "seconds": round(seconds, 2),
+                "result_mb": round(os.path.getsize(result_path) / 1024**2, 1),
+            }
+            if args.gzip:
+                gzip_size = os.path.getsize(f"{result_path}.gz")
+                row["result_gz_mb"] = round(gzip_size / 1024**2, 2)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(root)
+        rows.append(row)
+        print(row)
+
+    print(pd.DataFrame(rows).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
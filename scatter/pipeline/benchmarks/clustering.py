@@ -0,0 +1,88 @@
+"""
+Compare the exact clustering path with the large-N path on synthetic data.
+
+Run from scatter/pipeline:
+
+    python -m benchmarks.clustering --sizes 10000 50000 200000 1000000
+
+For every size, the script reports the wall time of each path and the
+adjusted Rand index (ARI) of their clusters against the synthetic topics
+and against each other. The exact path is skipped above --max-exact.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn.metrics import adjusted_rand_score
+
+from steps.clustering import cluster_embeddings, cluster_embeddings_large
+
+
+def synthetic_embeddings(n, n_topics, dim, seed=42):
+    # トピックごとの中心の周りに正規分布で点を生成する
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_topics, dim))
+    topics = rng.integers(n_topics, size=n)
+    embeddings = centers[topics] + rng.normal(scale=0.6, size=(n, dim))
+    return embeddings, topics
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 50000])
+    parser.add_argument("--clusters", type=int, default=8)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--sample-size", type=int, default=50000)
+    parser.add_argument("--max-exact", type=int, default=200000)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    rows = []
+    for n in args.sizes:
+        embeddings, topics = synthetic_embeddings(n, args.clusters, args.dim)
+        metadatas = {
+            "arg-id": np.array([f"A{i}_0" for i in range(n)]),
+            "comment-id": np.arange(n),
+        }
+        row = {"arguments": n}
+
+        exact = None
+        if n <= args.max_exact:
+            docs = np.array([f"topic{t} 意見{i}" for i, t in enumerate(topics)])
+            started = time.perf_counter()
+            exact = cluster_embeddings(
+                docs=docs,
+                embeddings=embeddings,
+                metadatas=metadatas,
+                min_cluster_size=args.clusters,
+                n_topics=args.clusters,
+            )
+            row["exact_seconds"] = round(time.perf_counter() - started, 1)
+            row["exact_ari_topics"] = adjusted_rand_score(topics, exact["cluster-id"])
+
+        started = time.perf_counter()
+        large = cluster_embeddings_large(
+            embeddings=embeddings,
+            metadatas=metadatas,
+            min_cluster_size=args.clusters,
+            n_topics=args.clusters,
+            sample_size=args.sample_size,
+        )
+        row["large_seconds"] = round(time.perf_counter() - started, 1)
+        row["large_ari_topics"] = adjusted_rand_score(topics, large["cluster-id"])
+        if exact is not None:
+            row["ari_exact_vs_large"] = adjusted_rand_score(
+                exact["cluster-id"], large["cluster-id"]
+            )
+        rows.append(row)
+        print(row)
+
+    print(pd.DataFrame(rows).round(3).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+"""
+A local stand-in for the OpenAI API, for benchmarks that must not spend money.
+
+Run from scatter/pipeline:
+
+    python -m benchmarks.fake_openai --port 8765 --latency 0.2 --error-rate 0.01 --rate-limit-rate 0.02
+
+and point the pipeline at it with
+
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_BASE=http://127.0.0.1:8765/v1 OPENAI_API_KEY=fake
+
+The server answers POST /v1/chat/completions and POST /v1/embeddings after
+a random delay around --latency seconds. It fails a share of the requests
+with 500 (--error-rate) or 429 with a Retry-After header
+(--rate-limit-rate). GET /stats returns the number of requests served.
+
+The answers have the shape each step expects, so that every step runs
+through: extraction gets a JSON list with one argument per sentence of the
+comment, classification and translation get JSON objects with the ids they
+sent, the selection of representative arguments gets ids from the prompt,
+and the other prompts get a short text. Embeddings are deterministic, and
+texts sharing words get close vectors.
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+EMBEDDING_DIMENSIONS = {
+    "text-embedding-3-large": 3072,
+    "text-embedding-3-small": 1536,
+}
+
+
+def _tokens(text) -> int:
+    # 料金の目安になれば十分なので、日本語の1文字を約1トークンとして数える
+    return max(1, len(text))
+
+
+def _sentences(text) -> list[str]:
+    sentences = [s.strip() for s in re.split(r"(?<=[。．.!?！？\n])", text)]
+    return [s for s in sentences if s] or [text.strip()]
+
+
+def _classification(prompt) -> dict:
+    categories = {}
+    for name, block in re.findall(r"## カテゴリ「(.+?)」の分類先\n((?:- .*\n?)*)", prompt):
+        values = re.findall(r"- \('(.*?)',", block)
+        categories[name] = values or ["その他"]
+    ids = re.findall(r"^- (\S+?): ", prompt.split("# 分類する意見", 1)[-1], re.M)
+    return {
+        id: {
+            name: values[int(hashlib.md5(f"{id}{name}".encode()).hexdigest(), 16) % len(values)]
+            for name, values in categories.items()
+        }
+        for id in ids
+    }
+
+
+def chat_answer(messages, response_format=None) -> str:
+    system = messages[0]["content"] if messages else ""
+    content = messages[-1]["content"] if messages else ""
+    if "カテゴリに分類" in system:
+        return json.dumps(_classification(system), ensure_ascii=False)
+    if response_format and content.lstrip().startswith("{"):
+        # 翻訳: 受け取った id をそのまま返す
+        try:
+            batch = json.loads(content)
+        except json.JSONDecodeError:
+            batch = {}
+        return json.dumps(
+            {id: f"[translated] {text}" for id, text in batch.items()}, ensure_ascii=False
+        )
+    if response_format:
+        return "{}"
+    if "ラベル名と関連度" in content:
+        ids = re.findall(r"^(\S+?): ", content.split("# 各データ点のテキスト", 1)[-1], re.M)
+        return ",".join(ids[:5])
+    # 抽出: プロンプトの回答例 (/ai のあとの部分) がリストなら、文ごとに1件の意見のリストを返す
+    examples = [m["content"] for m in messages if m["role"] == "assistant"]
+    if any(e.lstrip().startswith("[") for e in examples) or re.search(r"^/ai\s*\[", system, re.M):
+        return json.dumps(_sentences(content), ensure_ascii=False)
+    return f"合成された応答 {hashlib.md5(content.encode()).hexdigest()[:8]}"
+
+
+# 単語をこの数のバケットに振り分けてから、固定の乱数行列で埋め込みの次元に射影する
+BUCKETS = 1024
+
+
+@lru_cache(maxsize=None)
+def _projection(dimensions) -> np.ndarray:
+    return np.random.default_rng(0).standard_normal((BUCKETS, dimensions), dtype=np.float32)
+
+
+def _bucket(word) -> int:
+    return int.from_bytes(hashlib.md5(str(word).encode()).digest()[:4], "little") % BUCKETS
+
+
+def embed(values, dimensions) -> np.ndarray:
+    """
+    Unit vectors for `values` (texts or token lists): the sum of the random
+    vectors of their words, so that texts sharing words are close.
+    """
+    counts = np.zeros((len(values), BUCKETS), dtype=np.float32)
+    for i, value in enumerate(values):
+        if isinstance(value, str):
+            # 日本語は空白で区切られないので、2文字ずつの組を単語とみなす
+            words = [value[j : j + 2] for j in range(max(1, len(value) - 1))]
+        else:
+            words = value
+        for word in words:
+            counts[i, _bucket(word)] += 1
+    vectors = counts @ _projection(dimensions)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+class FakeOpenAI(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.2, error_rate=0.0, rate_limit_rate=0.0, retry_after=1.0, seed=None):
+        super().__init__(address, Handler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.stats = Counter()
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def count(self, **counts):
+        with self.lock:
+            self.stats.update(counts)
+
+    def failure(self):
+        with self.lock:
+            r = self.random.random()
+        if r < self.rate_limit_rate:
+            return 429
+        if r < self.rate_limit_rate + self.error_rate:
+            return 500
+        return None
+
+    def delay(self):
+        with self.lock:
+            return self.latency * self.random.uniform(0.5, 1.5)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, headers=()):
+        data = json.dumps(body, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/stats"):
+            with self.server.lock:
+                self._send(200, dict(self.server.stats))
+        else:
+            self._send(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if self.path.endswith("/chat/completions"):
+            endpoint, answer = "chat", self._chat
+        elif self.path.endswith("/embeddings"):
+            endpoint, answer = "embeddings", self._embeddings
+        else:
+            self._send(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+
+        time.sleep(self.server.delay())
+        status = self.server.failure()
+        if status == 429:
+            self.server.count(**{f"{endpoint}_rate_limited": 1})
+            self._send(
+                429,
+                {"error": {"message": "Rate limit reached", "type": "rate_limit_error"}},
+                headers=[("Retry-After", str(self.server.retry_after))],
+            )
+        elif status == 500:
+            self.server.count(**{f"{endpoint}_errors": 1})
+            self._send(500, {"error": {"message": "Injected error", "type": "server_error"}})
+        else:
+            self._send(200, answer(request))
+
+    def _chat(self, request):
+        messages = request.get("messages", [])
+        content = chat_answer(messages, request.get("response_format"))
+        prompt_tokens = sum(_tokens(m.get("content") or "") for m in messages)
+        completion_tokens = _tokens(content)
+        self.server.count(chat=1, chat_prompt_tokens=prompt_tokens, chat_completion_tokens=completion_tokens)
+        return {
+            "id": f"chatcmpl-{hashlib.md5(content.encode()).hexdigest()[:12]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", ""),
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    def _embeddings(self, request):
+        model = request.get("model", "")
+        dimensions = request.get("dimensions") or EMBEDDING_DIMENSIONS.get(model, 1536)
+        inputs = request.get("input", [])
+        # 1件の文字列・トークン列も、そのリストも受け付ける
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        data = []
+        for i, vector in enumerate(embed(inputs, dimensions)):
+            if request.get("encoding_format") == "base64":
+                embedding = base64.b64encode(vector.astype("<f4").tobytes()).decode()
+            else:
+                embedding = vector.tolist()
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+        tokens = sum(_tokens(v) for v in inputs)
+        self.server.count(embeddings=1, embedding_inputs=len(inputs), embedding_tokens=tokens)
+        return {
+            "object": "list",
+            "data": data,
+            "model": model,
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        }
+
+
+def start_server(host="127.0.0.1", port=0, **options) -> FakeOpenAI:
+    """Start the server in a background thread; port 0 picks a free port."""
+    server = FakeOpenAI((host, port), **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def add_server_arguments(parser):
+    parser.add_argument("--latency", type=float, default=0.2, help="mean seconds per request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests failing with 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of requests failing with 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After of the 429 responses")
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def server_options(args) -> dict:
+    return {
+        "latency": args.latency,
+        "error_rate": args.error_rate,
+        "rate_limit_rate": args.rate_limit_rate,
+        "retry_after": args.retry_after,
+        "seed": args.seed,
+    }
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_server_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    server = FakeOpenAI((args.host, args.port), **server_options(args))
+    print(f"Serving a fake OpenAI API at {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+"""
+Run the whole pipeline on synthetic comments against a local fake OpenAI API.
+
+Run from scatter/pipeline:
+
+    python -m benchmarks.pipeline --sizes 1000 10000 --latency 0.2 --rate-limit-rate 0.02
+
+For every size, the script sets up a temporary copy of scatter/ whose
+pipeline/ and next-app/ link to the code of the repository but have their
+own inputs/, configs/ and outputs/, so that nothing is written to the
+repository. It writes inputs/benchmark-<size>.csv (see
+benchmarks/synthetic.py) and configs/benchmark-<size>.json there, and runs
+`python main.py configs/benchmark-<size>.json -f --skip-interaction` with
+OPENAI_BASE_URL pointing at the server of benchmarks/fake_openai.py and an
+empty cache directory. It reports the wall time, peak RSS, API calls and
+retries of every step, read from status.json and sampled from /proc while
+the pipeline runs.
+"""
+
+import argparse
+import copy
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import pandas as pd
+
+from benchmarks.fake_openai import add_server_arguments, server_options, start_server
+from benchmarks.synthetic import write_synthetic_comments
+
+# 外部の設定を指定しない場合の設定。抽出・分類・翻訳を含め、すべてのステップを通す
+DEFAULT_CONFIG = {
+    "question": "これからの暮らしについてどんな意見が寄せられているのか？",
+    "intro": "合成データによるベンチマークです。",
+    "model": "gpt-4o-mini",
+    "extraction": {
+        "workers": 16,
+        "properties": ["source", "age"],
+        "categories": {
+            "分野": {
+                "政策": "政策について述べている場合につける",
+                "生活": "生活について述べている場合につける",
+            }
+        },
+    },
+    "embedding": {"model": "text-embedding-3-small"},
+    "clustering": {"clusters": 8},
+    "translation": {"languages": ["English"], "flags": ["US"]},
+}
+
+SAMPLE_INTERVAL = 0.2
+
+PIPELINE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+NEXT_APP_DIR = os.path.join(os.path.dirname(PIPELINE_DIR), "next-app")
+# 実行ごとに作る (リンクしない) ディレクトリ
+WORKSPACE_DIRS = {
+    "pipeline": ["inputs", "configs", "outputs", "cache"],
+    # next-app はビルド結果を ../pipeline/outputs/<name>/report に書き出す
+    "next-app": [".next", "out"],
+}
+
+
+def make_workspace(root) -> str:
+    """
+    Mirror pipeline/ and next-app/ in `root` with symbolic links to their
+    files, except for the directories the run writes to. Returns the
+    pipeline directory of the mirror.
+    """
+    for name, source in [("pipeline", PIPELINE_DIR), ("next-app", NEXT_APP_DIR)]:
+        target = os.path.join(root, name)
+        os.makedirs(target)
+        if not os.path.isdir(source):
+            continue
+        for entry in os.listdir(source):
+            if entry not in WORKSPACE_DIRS[name]:
+                os.symlink(os.path.join(source, entry), os.path.join(target, entry))
+        for entry in WORKSPACE_DIRS[name]:
+            if name == "pipeline":
+                os.makedirs(os.path.join(target, entry))
+    return os.path.join(root, "pipeline")
+
+
+def benchmark_config(template, name, n):
+    config = copy.deepcopy(template)
+    config["name"] = name
+    config["input"] = name
+    config.setdefault("extraction", {})["limit"] = n
+    return config
+
+
+def _rss_mb(pid) -> float | None:
+    # Linux 以外では /proc がないので、ステップごとの値は取れない (全体のピークは wait4 で取る)
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+
+def _running_steps(progress_path) -> list[str]:
+    try:
+        with open(progress_path) as f:
+            return list(json.load(f).get("running_jobs", {}))
+    except (OSError, ValueError):
+        return []
+
+
+def sample_step_rss(pid, progress_path, peaks, done):
+    """
+    Record in `peaks` the largest RSS of the process seen while each step was
+    running. Steps running at the same time share their samples.
+    """
+    while not done.wait(SAMPLE_INTERVAL):
+        rss = _rss_mb(pid)
+        if rss is None:
+            continue
+        for step in _running_steps(progress_path):
+            peaks[step] = max(peaks.get(step, 0), rss)
+
+
+def run_pipeline(pipeline_dir, config_path, output_dir, env, log_path):
+    """Run main.py and return its wall time, peak RSS in MB and per-step peaks."""
+    peaks = {}
+    done = threading.Event()
+    with open(log_path, "w") as log:
+        started = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, "main.py", config_path, "-f", "--skip-interaction"],
+            cwd=pipeline_dir,
+            env=env,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        )
+        sampler = threading.Thread(
+            target=sample_step_rss,
+            args=(
+                process.pid,
+                os.path.join(pipeline_dir, "outputs", output_dir, "progress.json"),
+                peaks,
+                done,
+            ),
+            daemon=True,
+        )
+        sampler.start()
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - started
+        process.returncode = os.waitstatus_to_exitcode(status)
+        done.set()
+        sampler.join()
+    # ru_maxrss は Linux では KB、macOS ではバイト
+    scale = 1024**2 if sys.platform == "darwin" else 1024
+    return seconds, usage.ru_maxrss / scale, peaks
+
+
+def server_stats(base_url) -> dict:
+    from urllib.request import urlopen
+
+    with urlopen(f"{base_url}/stats") as response:
+        return json.load(response)
+
+
+def step_rows(status, peaks):
+    rows = []
+    for job in status.get("completed_jobs", []):
+        metrics = job.get("metrics", {})
+        rows.append(
+            {
+                "step": job["step"],
+                "seconds": round(job["duration"], 2),
+                "peak_rss_mb": round(peaks[job["step"]]) if job["step"] in peaks else None,
+                "calls": metrics.get("calls"),
+                "cache_hits": metrics.get("cache_hits"),
+                "retries": metrics.get("retries"),
+                "tokens": metrics.get("prompt_tokens", 0) + metrics.get("completion_tokens", 0),
+                "latency_p95": metrics.get("latency_p95"),
+            }
+        )
+    return rows
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000])
+    parser.add_argument(
+        "--config",
+        help="config JSON used as a template instead of the built-in one (input, name and extraction.limit are replaced)",
+    )
+    parser.add_argument(
+        "--base-url",
+        help="use an already running fake server (e.g. http://127.0.0.1:8765/v1) instead of starting one",
+    )
+    parser.add_argument("--keep", action="store_true", help="keep the temporary directory with the inputs, configs, outputs and logs")
+    parser.add_argument("--json", help="also write the results to this JSON file")
+    add_server_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    if args.config:
+        with open(args.config) as f:
+            template = json.load(f)
+    else:
+        template = DEFAULT_CONFIG
+
+    if args.base_url:
+        base_url = args.base_url.rstrip("/")
+    else:
+        server = start_server(**server_options(args))
+        base_url = server.base_url
+    print(f"Fake OpenAI API at {base_url}")
+
+    results = []
+    for n in args.sizes:
+        name = f"benchmark-{n}"
+        work_dir = tempfile.mkdtemp(prefix="pipeline-benchmark-")
+        pipeline_dir = make_workspace(work_dir)
+        write_synthetic_comments(os.path.join(pipeline_dir, "inputs", f"{name}.csv"), n)
+        config_path = f"configs/{name}.json"
+        with open(os.path.join(pipeline_dir, config_path), "w") as f:
+            json.dump(benchmark_config(template, name, n), f, ensure_ascii=False, indent=2)
+        env = {
+            **os.environ,
+            "OPENAI_API_KEY": "benchmark",
+            "OPENAI_BASE_URL": base_url,
+            # langchain の OpenAIEmbeddings はこちらを読む
+            "OPENAI_API_BASE": base_url,
+            # 以前の実行のキャッシュを使わない
+            "PIPELINE_CACHE_DIR": os.path.join(pipeline_dir, "cache"),
+        }
+        env.pop("USE_AZURE", None)
+        log_path = os.path.join(work_dir, "main.log")
+        before = server_stats(base_url)
+        seconds, peak_rss, peaks = run_pipeline(pipeline_dir, config_path, name, env, log_path)
+        after = server_stats(base_url)
+        try:
+            with open(os.path.join(pipeline_dir, "outputs", name, "status.json")) as f:
+                status = json.load(f)
+        except FileNotFoundError:
+            status = {}
+
+        requests = {key: value - before.get(key, 0) for key, value in after.items()}
+        steps = step_rows(status, peaks)
+        result = {
+            "comments": n,
+            "status": status.get("status"),
+            "seconds": round(seconds, 2),
+            "peak_rss_mb": round(peak_rss),
+            "requests": requests,
+            "steps": steps,
+        }
+        results.append(result)
+
+        print(f"\n{n} comments: {result['status']} in {result['seconds']}s, peak RSS {result['peak_rss_mb']} MB")
+        print(f"Requests to the fake API: {json.dumps(requests, sort_keys=True)}")
+        if steps:
+            print(pd.DataFrame(steps).to_string(index=False))
+        if status.get("status") != "completed" or args.keep:
+            print(f"Log and outputs: {work_dir}")
+        else:
+            shutil.rmtree(work_dir)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
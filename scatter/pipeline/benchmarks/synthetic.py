@@ -0,0 +1,118 @@
+"""
+Write synthetic comment files for the end-to-end benchmarks.
+
+Run from scatter/pipeline:
+
+    python -m benchmarks.synthetic --sizes 1000 10000 100000 1000000
+
+For every size, the script writes benchmarks/data/synthetic-<size>.csv
+(or to --output-dir) with the columns of the example inputs (comment-id,
+comment-body, source, age). Every comment is one to three sentences about one of a few topics, so
+that the arguments extracted from them form clusters.
+"""
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+# トピックごとの語彙。同じトピックのコメントは語彙を共有するので、埋め込みが近くなる
+TOPICS = {
+    "環境": ["再生可能エネルギー", "森林保全", "プラスチック削減", "脱炭素", "省エネ住宅"],
+    "教育": ["給付型奨学金", "教員の働き方", "デジタル教材", "少人数学級", "生涯学習"],
+    "子育て": ["保育所の整備", "育児休業", "児童手当", "学童保育", "出産費用"],
+    "医療": ["地域医療", "医師不足", "予防接種", "オンライン診療", "介護人材"],
+    "経済": ["最低賃金", "中小企業支援", "スタートアップ", "物価対策", "地方創生"],
+    "交通": ["公共交通", "自動運転", "自転車道", "地方の路線バス", "高齢者の移動"],
+    "行政": ["行政手続きのデジタル化", "情報公開", "住民参加", "税の使い道", "窓口の待ち時間"],
+    "防災": ["避難所の環境", "耐震化", "ハザードマップ", "防災教育", "備蓄"],
+}
+# BERTopic は英数字以外を取り除いてから語彙を作るので、英字の語も混ぜておく
+# (日本語だけのデータでは語彙が空になり、clustering が失敗する)
+ASPECTS = [
+    "予算", "制度", "情報発信", "地域差", "担い手", "長期的な計画", "利用しやすさ", "費用負担",
+    "KPI", "DX",
+]
+ENDINGS = [
+    "を充実させるべきです",
+    "を見直してほしいです",
+    "について議論を深めるべきだと思います",
+    "がまだ足りないと感じています",
+    "を優先して取り組んでほしい",
+    "をもっと分かりやすくしてほしい",
+]
+PLACES = [
+    "札幌", "仙台", "東京", "横浜", "新潟", "金沢", "名古屋", "京都", "大阪", "神戸",
+    "岡山", "広島", "松山", "高知", "福岡", "長崎", "熊本", "那覇", "私の町", "地方",
+]
+OPENINGS = ["", "ぜひ", "できるだけ早く", "今後は", "何よりも", "将来に向けて"]
+SOURCES = ["Google Form", "X API", "Web"]
+
+
+def synthetic_sentences(rng, topics):
+    """One sentence about each of `topics` (an array of topic positions)."""
+    # 約20万通りの文になるので、大きなデータセットでは同じ意見が繰り返し現れる
+    n = len(topics)
+    subjects = np.array(list(TOPICS.values()))
+    parts = [
+        np.array(OPENINGS)[rng.integers(len(OPENINGS), size=n)],
+        np.array(PLACES)[rng.integers(len(PLACES), size=n)],
+        "では",
+        subjects[topics, rng.integers(subjects.shape[1], size=n)],
+        "の",
+        np.array(ASPECTS)[rng.integers(len(ASPECTS), size=n)],
+        np.array(ENDINGS)[rng.integers(len(ENDINGS), size=n)],
+        "。",
+    ]
+    sentences = parts[0]
+    for part in parts[1:]:
+        sentences = np.char.add(sentences, part)
+    return sentences
+
+
+def synthetic_comments(n, seed=42) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    # トピックの大きさに偏りをつける
+    weights = rng.dirichlet(np.ones(len(TOPICS)) * 2)
+    comment_topics = rng.choice(len(TOPICS), size=n, p=weights)
+    # 1つのコメントに1〜3文 (平均で約2件の意見が抽出される)
+    n_sentences = rng.choice([1, 2, 3], size=n, p=[0.35, 0.35, 0.3])
+    sentences = synthetic_sentences(rng, np.repeat(comment_topics, n_sentences))
+    starts = np.concatenate([[0], np.cumsum(n_sentences)[:-1]])
+    bodies = [
+        "".join(sentences[start : start + k]) for start, k in zip(starts, n_sentences)
+    ]
+    return pd.DataFrame(
+        {
+            "comment-id": np.arange(1, n + 1),
+            "comment-body": bodies,
+            "source": rng.choice(SOURCES, size=n),
+            "age": rng.integers(18, 80, size=n),
+        }
+    )
+
+
+def write_synthetic_comments(path, n, seed=42):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    synthetic_comments(n, seed).to_csv(path, index=False)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output-dir", default=os.path.join("benchmarks", "data"))
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    for n in args.sizes:
+        path = os.path.join(args.output_dir, f"synthetic-{n}.csv")
+        write_synthetic_comments(path, n, args.seed)
+        print(f"{path}: {n} comments, {os.path.getsize(path) / 1024**2:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -13,7 +13,7 @@ from steps.overview import overview
 from steps.takeaways import takeaways
 from steps.translation import translation
 from steps.visualization import visualization
-from utils import initialization, run_step, termination
+from utils import initialization, run_pipeline, termination
 
 
 def parse_arguments():
@@ -39,6 +39,11 @@ def parse_arguments():
         action="store_true",
         help="Skip the interactive confirmation prompt and run pipeline immediately."
     )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only process comments added since the previous run and update the clusters, labels and takeaways in place."
+    )
     return parser.parse_args()
 
 
@@ -53,19 +58,27 @@ def main():
         new_argv.extend(["-o", args.only])
     if args.skip_interaction:
         new_argv.append("-skip-interaction")
+    if args.incremental:
+        new_argv.append("-incremental")
     
     config = initialization(new_argv)
 
     try:
-        run_step("extraction", extraction, config)
-        run_step("embedding", embedding, config)
-        run_step("clustering", clustering, config)
-        run_step("labelling", labelling, config)
-        run_step("takeaways", takeaways, config)
-        run_step("overview", overview, config)
-        run_step("translation", translation, config)
-        run_step("aggregation", aggregation, config)
-        run_step("visualization", visualization, config)
+        # each step runs as soon as the steps it depends on (see specs.json) are done
+        run_pipeline(
+            config,
+            {
+                "extraction": extraction,
+                "embedding": embedding,
+                "clustering": clustering,
+                "labelling": labelling,
+                "takeaways": takeaways,
+                "overview": overview,
+                "translation": translation,
+                "aggregation": aggregation,
+                "visualization": visualization,
+            },
+        )
         termination(config)
     except Exception as e:
         termination(config, error=e)
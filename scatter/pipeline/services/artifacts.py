@@ -0,0 +1,163 @@
+"""Read and write the tables passed between steps (args, clusters, labels, takeaways)
+and the input CSV, parsing each file only once per run."""
+
+import os
+import tempfile
+import threading
+
+import pandas as pd
+
+# 既知の列の型。ここにない列 (元データの属性など) は読み込み時に推論される
+SCHEMAS = {
+    "args": {"arg-id": str, "comment-id": "int64", "argument": str},
+    "clusters": {
+        "arg-id": str,
+        "x": "float64",
+        "y": "float64",
+        "probability": "float64",
+        "cluster-id": "int64",
+    },
+    "labels": {
+        "cluster-id": "int64",
+        "label": str,
+        "size": "int64",
+        "representatives": str,
+    },
+    "takeaways": {"cluster-id": "int64", "takeaways": str, "size": "int64"},
+}
+FORMATS = ["csv", "parquet"]
+
+
+class TableLoader:
+    """
+    1回の実行の中で読み込んだ表を、パス・列・更新時刻をキーにして保持する。
+    ファイルが書き換えられると更新時刻が変わるので、次の読み込みで読み直される。
+    呼び出し元が変更してもよいように、返すのは常にコピー。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tables = {}
+
+    def load(self, path, read, columns=None) -> pd.DataFrame:
+        """
+        Return the table at `path` parsed with `read(path, columns)`.
+        Only `columns` are read from the file when given, unless the whole
+        table is already held.
+        """
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        key = tuple(columns) if columns is not None else None
+        with self._lock:
+            tables = self._tables.get(path, {})
+            cached_version, df = tables.get(key, (None, None))
+            if cached_version != version and key is not None:
+                # 全列を読み込み済みであれば、そこから列を選ぶ
+                cached_version, df = tables.get(None, (None, None))
+                if cached_version == version:
+                    df = df[list(key)]
+        if cached_version != version:
+            # 大きな入力でも使う列だけを読み込む (Parquetでは他の列を読み飛ばせる)
+            df = read(path, key)
+            if key is not None:
+                df = df[list(key)]
+            with self._lock:
+                tables = self._tables.setdefault(path, {})
+                # 古い版の表は捨てる
+                for k in [k for k, (v, _) in tables.items() if v != version]:
+                    del tables[k]
+                tables[key] = (version, df)
+        return df.copy()
+
+    def invalidate(self, path):
+        with self._lock:
+            self._tables.pop(path, None)
+
+
+LOADER = TableLoader()
+
+
+def artifact_format(config) -> str:
+    return config.get("artifact_format", "csv")
+
+
+def artifact_path(config, name, format=None) -> str:
+    format = format or artifact_format(config)
+    return f"outputs/{config['output_dir']}/{name}.{format}"
+
+
+def output_path(config, filename) -> str:
+    """Path of a step output as named in specs.json, in the configured format."""
+    name, ext = os.path.splitext(filename)
+    if ext == ".csv" and name in SCHEMAS:
+        return artifact_path(config, name)
+    return f"outputs/{config['output_dir']}/{filename}"
+
+
+def _schema(config, name) -> dict:
+    schema = dict(SCHEMAS[name])
+    if name == "args":
+        # 分類カテゴリはラベルの文字列 (数字だけのラベルも文字列のまま扱う)
+        for category in config.get("extraction", {}).get("categories", {}) or {}:
+            schema[category] = str
+    return schema
+
+
+def read_artifact(config, name, columns=None) -> pd.DataFrame:
+    """
+    Read the `name` artifact of the run, with the types of its schema.
+    Only `columns` are returned when given.
+    """
+    schema = _schema(config, name)
+    path = artifact_path(config, name)
+    if artifact_format(config) == "parquet" and os.path.exists(path):
+        read = lambda path, columns: pd.read_parquet(path, columns=columns)
+    else:
+        # CSVで出力された過去の実行結果もそのまま読めるようにする
+        path = artifact_path(config, name, "csv")
+        read = lambda path, columns: pd.read_csv(path, dtype=schema, usecols=columns)
+    return LOADER.load(path, read, columns)
+
+
+def read_input(config, columns=None) -> pd.DataFrame:
+    """Read the input CSV file of the run."""
+    read = lambda path, columns: pd.read_csv(path, usecols=columns)
+    return LOADER.load(f"inputs/{config['input']}.csv", read, columns)
+
+
+def atomic_write(path, write):
+    # 書き込み途中で中断されても、壊れたファイルが残らないようにする
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def write_artifact(config, name, df: pd.DataFrame):
+    """
+    Write the `name` artifact of the run in the configured format.
+    A CSV copy is always written so that the outputs stay readable by humans.
+    """
+    schema = _schema(config, name)
+    numeric = {
+        column: dtype
+        for column, dtype in schema.items()
+        if column in df.columns and dtype is not str
+    }
+    df = df.astype(numeric)
+    if artifact_format(config) == "parquet":
+        atomic_write(
+            artifact_path(config, name, "parquet"),
+            lambda path: df.to_parquet(path, index=False),
+        )
+    atomic_write(
+        artifact_path(config, name, "csv"),
+        lambda path: df.to_csv(path, index=False),
+    )
+    for format in FORMATS:
+        LOADER.invalidate(artifact_path(config, name, format))
@@ -1,10 +1,15 @@
 import concurrent.futures
 import json
+from collections import defaultdict
 
 import pandas as pd
 from tqdm import tqdm
 
-from services.llm import request_to_openai
+from services.disk_cache import DiskCache, cache_key
+from services.llm import count_tokens, submit_to_openai
+
+# 意見・カテゴリ (名前と定義)・モデルごとの分類結果。カテゴリや意見を追加しても、未分類のものだけを問い合わせる
+CLASSIFICATION_CACHE = DiskCache("classification")
 
 BASE_CLASSIFICATION_PROMPT = """与えられた意見群をカテゴリに分類してください
 
@@ -115,54 +120,124 @@ def _parse_arg_result(classification_results: dict, arg_id: str, categories: lis
     return parsed_result
 
 
-def classify_batch_args(batch_args: pd.DataFrame, categories: dict, model: str) -> dict:
+def _batch_messages(batch_args: pd.DataFrame, categories: dict) -> list[dict]:
     category_string = _build_categories_string(categories)
     batch_args_string = _build_batch_args_string(batch_args)
     prompt = BASE_CLASSIFICATION_PROMPT.format(
         categories_string=category_string, args_string=batch_args_string
     )
-    result = request_to_openai(
-        messages=[
-            {"role": "system", "content": prompt},
-        ],
-        model=model,
-        is_json=True,
-    )
+    return [
+        {"role": "system", "content": prompt},
+    ]
+
+
+def _validator(arg_ids: list[str], categories: list[str]):
+    # すべての意見とカテゴリの分類を含む応答だけをキャッシュする
+    def validate(response):
+        result = _parse_batch_result(response)
+        return all(
+            value is not None
+            for arg_id in arg_ids
+            for value in _parse_arg_result(result, arg_id, categories).values()
+        )
+
+    return validate
+
+
+def _parse_batch_result(result: str) -> dict:
     try:
         return json.loads(result)
     except json.JSONDecodeError:
         return {}
 
 
-def classify_args(args: pd.DataFrame, config, workers: int) -> pd.DataFrame:
+def pack_batches(args: pd.DataFrame, model: str, batch_tokens: int, batch_size: int):
+    """
+    Split the rows of `args` into consecutive, non-overlapping batches of
+    positions, each holding at most `batch_size` arguments and `batch_tokens`
+    tokens of arguments.
+    """
+    batches = []
+    batch = []
+    tokens = 0
+    lines = [f"- {id}: {argument}" for id, argument in zip(args["arg-id"], args["argument"])]
+    for position, line in enumerate(lines):
+        n = count_tokens(line, model)
+        if batch and (tokens + n > batch_tokens or len(batch) >= batch_size):
+            batches.append(batch)
+            batch = []
+            tokens = 0
+        batch.append(position)
+        tokens += n
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def classify_args(args: pd.DataFrame, config) -> pd.DataFrame:
+    categories = config["extraction"]["categories"]
+    model = config["extraction"]["model"]
     batch_size = config["extraction"]["category_batch_size"]
+    batch_tokens = config["extraction"]["category_batch_tokens"]
 
-    classification_results = {}
-    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
-        batch_start_indices = range(0, len(args), batch_size)
-        future_to_batch = {
-            executor.submit(
-                classify_batch_args,
-                args.loc[batch_idx: batch_idx + batch_size],
-                config["extraction"]["categories"],
-                config["extraction"]["model"],
-            ): batch_idx
-            for batch_idx in batch_start_indices
+    arg_ids = args["arg-id"].to_list()
+    keys = [
+        {
+            category: cache_key(argument, category, definition, model)
+            for category, definition in categories.items()
         }
-        for future in tqdm(
-            concurrent.futures.as_completed(future_to_batch),
-            total=len(batch_start_indices),
-            desc="Classifying arguments"
-        ):
-            result = future.result()
-            classification_results.update(result)
+        for argument in args["argument"]
+    ]
+    classified = CLASSIFICATION_CACHE.get_many(
+        [key for arg_keys in keys for key in arg_keys.values()]
+    )
+
+    # まだ分類されていないカテゴリの組み合わせごとに、意見をまとめて問い合わせる
+    groups = defaultdict(list)
+    for position, arg_keys in enumerate(keys):
+        missing = tuple(c for c, key in arg_keys.items() if key not in classified)
+        if missing:
+            groups[missing].append(position)
+
+    # 全バッチをLLMエンジンに投入し、同時実行数とレート制限はエンジン側で調整する
+    futures = {}
+    for missing, positions in groups.items():
+        batch_categories = {category: categories[category] for category in missing}
+        group = args.iloc[positions]
+        for batch in pack_batches(group, model, batch_tokens, batch_size):
+            future = submit_to_openai(
+                messages=_batch_messages(group.iloc[batch], batch_categories),
+                model=model,
+                is_json=True,
+                validate=_validator(group["arg-id"].iloc[batch].tolist(), list(missing)),
+            )
+            futures[future] = ([positions[i] for i in batch], missing)
+    for future in tqdm(
+        concurrent.futures.as_completed(futures),
+        total=len(futures),
+        desc="Classifying arguments"
+    ):
+        batch, missing = futures[future]
+        result = _parse_batch_result(future.result())
+        new = {}
+        for position in batch:
+            arg_result = _parse_arg_result(result, arg_ids[position], list(missing))
+            for category in missing:
+                # 分類に失敗したものは保存せず、次の実行で再び問い合わせる
+                if arg_result[category] is not None:
+                    new[keys[position][category]] = arg_result[category]
+        CLASSIFICATION_CACHE.set_many(new)
+        classified.update(new)
 
     # 結果をdataframeに変換し、argsにjoinする
-    results = []
-    categories = list(config["extraction"]["categories"].keys())
-    for arg_id in args["arg-id"]:
-        arg_result = _parse_arg_result(classification_results, arg_id, categories)
-        results.append(arg_result)
-    classification_results_df = pd.DataFrame(results)
+    classification_results_df = pd.DataFrame(
+        {
+            "arg-id": arg_ids,
+            **{
+                category: [classified.get(arg_keys[category]) for arg_keys in keys]
+                for category in categories
+            },
+        }
+    )
     merged = args.merge(classification_results_df, on="arg-id", how="left")
     return merged
@@ -0,0 +1,100 @@
+"""Per-cluster row index shared by the steps working cluster by cluster."""
+
+import numpy as np
+import pandas as pd
+
+
+class ClusterIndex:
+    """
+    clusters.csv の行をクラスタごとにまとめた索引。
+    一度だけ作っておけば、クラスタごとの抽出・サンプリング・上位k件の取得・
+    確率の更新が、表全体の走査ではなくクラスタの大きさに比例する計算量で行える。
+    返す位置はすべて table の行番号 (iloc) で、クラスタ内では元の表の順番に並ぶ。
+    """
+
+    def __init__(self, table: pd.DataFrame, column: str = "cluster-id"):
+        self.table = table
+        self.column = column
+        # factorize の順番は unique() と同じ (出現順)
+        codes, cluster_ids = pd.factorize(table[column])
+        self.cluster_ids = cluster_ids.to_numpy()
+        self._codes = codes
+        order = np.argsort(codes, kind="stable")
+        bounds = np.cumsum(np.bincount(codes, minlength=len(cluster_ids)))[:-1]
+        self._positions = dict(zip(self.cluster_ids, np.split(order, bounds)))
+        self._code_of = {cid: code for code, cid in enumerate(self.cluster_ids)}
+        self._arg_positions = pd.Series(
+            np.arange(len(table)), index=table["arg-id"].values
+        )
+
+    def positions(self, cid) -> np.ndarray:
+        return self._positions.get(cid, np.array([], dtype=int))
+
+    def sizes(self) -> pd.Series:
+        return pd.Series(
+            [len(self._positions[cid]) for cid in self.cluster_ids],
+            index=pd.Index(self.cluster_ids, name=self.column),
+        )
+
+    def rows(self, cid) -> pd.DataFrame:
+        return self.table.iloc[self.positions(cid)]
+
+    def align(self, values_by_arg_id: pd.Series) -> np.ndarray:
+        """Reorder a Series indexed by arg-id to follow the rows of the table."""
+        return values_by_arg_id.reindex(self.table["arg-id"].values).values
+
+    def sample(self, cid, size, random=np.random) -> np.ndarray:
+        positions = self.positions(cid)
+        chosen = random.choice(positions, size=min(len(positions), size), replace=False)
+        return np.sort(chosen)
+
+    def sample_outside(self, cid, size, random=np.random) -> np.ndarray:
+        n_rows = len(self.table)
+        n_outside = n_rows - len(self.positions(cid))
+        size = min(n_outside, size)
+        if n_outside <= 2 * size:
+            outside = np.flatnonzero(self._codes != self._code_of.get(cid, -1))
+            return np.sort(random.choice(outside, size=size, replace=False))
+        # クラスタ外の行が十分に多いときは棄却サンプリングで全体の走査を避ける
+        chosen = np.array([], dtype=int)
+        while len(chosen) < size:
+            candidates = random.choice(n_rows, size=2 * (size - len(chosen)))
+            candidates = candidates[self._codes[candidates] != self._code_of.get(cid)]
+            chosen = pd.unique(np.concatenate([chosen, candidates]))
+        return np.sort(chosen[:size])
+
+    def top_k(self, cid, k, by="probability") -> np.ndarray:
+        positions = self.positions(cid)
+        values = self.table[by].values[positions]
+        order = np.argsort(-values, kind="stable")[:k]
+        return positions[order]
+
+    def add(self, arg_ids, column, delta):
+        positions = self._arg_positions.reindex(arg_ids).dropna().astype(int).values
+        values = self.table[column].values.copy()
+        np.add.at(values, positions, delta)
+        self.table[column] = values
+
+
+def cluster_random(seed, cid) -> np.random.RandomState:
+    """
+    Random generator for the samples of cluster `cid`. It only depends on
+    `seed` and `cid`, so that the prompts built from the samples (and so
+    their cached responses) stay the same from one run to the next, whatever
+    other clusters are sampled.
+    """
+    return np.random.RandomState([seed, int(cid) % 2**32])
+
+
+def changed_clusters(
+    index: ClusterIndex, previous: pd.DataFrame, threshold
+) -> np.ndarray:
+    """
+    Clusters of `index` that are not in `previous` (labels or takeaways written
+    with the size of each cluster), or whose size changed by more than
+    `threshold` relative to that size.
+    """
+    sizes = index.sizes()
+    previous_sizes = previous.set_index("cluster-id")["size"].reindex(sizes.index)
+    change = (sizes - previous_sizes).abs() / previous_sizes
+    return sizes.index[(change > threshold) | previous_sizes.isna()].to_numpy()
@@ -0,0 +1,115 @@
+"""Persistent content-addressed cache shared by all pipeline runs."""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+CACHE_DIR = os.getenv("PIPELINE_CACHE_DIR", "cache")
+
+
+def cache_key(*parts) -> str:
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class DiskCache:
+    """
+    JSONで表現できる値を、内容から計算したキーで保存するSQLiteベースのキャッシュ。
+    max_age_days を超えたエントリは読み出し時に無視され、
+    evict() で古いものから max_bytes に収まるまで削除される。
+    """
+
+    def __init__(self, name, max_bytes=None, max_age_days=None):
+        self.path = os.path.join(CACHE_DIR, f"{name}.sqlite3")
+        self.max_bytes = max_bytes
+        self.max_age = max_age_days * 24 * 60 * 60 if max_age_days else None
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(
+                self.path, timeout=30, isolation_level=None, check_same_thread=False
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL,"
+                "created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS entries_accessed ON entries(accessed)"
+            )
+            self._conn = conn
+        return self._conn
+
+    def _expired(self, created, now):
+        return self.max_age is not None and created < now - self.max_age
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys) -> dict:
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            # SQLiteのプレースホルダ数の上限に収まるように分割して問い合わせる
+            for i in range(0, len(keys), 500):
+                chunk = keys[i : i + 500]
+                rows = conn.execute(
+                    "SELECT key, value, created FROM entries WHERE key IN (%s)"
+                    % ",".join("?" * len(chunk)),
+                    chunk,
+                ).fetchall()
+                for key, value, created in rows:
+                    if not self._expired(created, now):
+                        found[key] = json.loads(value)
+            hits = list(found.keys())
+            for i in range(0, len(hits), 500):
+                chunk = hits[i : i + 500]
+                conn.execute(
+                    "UPDATE entries SET accessed = ? WHERE key IN (%s)"
+                    % ",".join("?" * len(chunk)),
+                    [now] + chunk,
+                )
+        return found
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def set_many(self, items: dict):
+        now = time.time()
+        rows = []
+        for key, value in items.items():
+            encoded = json.dumps(value, ensure_ascii=False)
+            rows.append((key, encoded, len(encoded.encode("utf-8")), now, now))
+        with self._lock:
+            self._connect().executemany(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)", rows
+            )
+
+    def evict(self):
+        if not os.path.exists(self.path):
+            return
+        with self._lock:
+            conn = self._connect()
+            if self.max_age is not None:
+                conn.execute(
+                    "DELETE FROM entries WHERE created < ?",
+                    (time.time() - self.max_age,),
+                )
+            if self.max_bytes is not None:
+                # 最近使われたものから順に累積サイズを数え、上限を超えた分を削除する
+                conn.execute(
+                    "DELETE FROM entries WHERE key IN ("
+                    "SELECT key FROM (SELECT key, SUM(size) OVER "
+                    "(ORDER BY accessed DESC, key) AS running FROM entries) "
+                    "WHERE running > ?)",
+                    (self.max_bytes,),
+                )
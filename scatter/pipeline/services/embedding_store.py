@@ -0,0 +1,69 @@
+"""Embedding vectors keyed by (model, text), shared across datasets."""
+
+import hashlib
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+from services.disk_cache import CACHE_DIR
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingStore:
+    """
+    埋め込みベクトルを float32 のバイト列として SQLite に保存する。
+    同じモデル・同じテキストの埋め込みはデータセットをまたいで再利用される。
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(CACHE_DIR, "embeddings.sqlite3")
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(
+                self.path, timeout=30, isolation_level=None, check_same_thread=False
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model TEXT NOT NULL, hash TEXT NOT NULL, vector BLOB NOT NULL,"
+                "PRIMARY KEY (model, hash))"
+            )
+            self._conn = conn
+        return self._conn
+
+    def get_many(self, model: str, texts: list[str]) -> dict[str, np.ndarray]:
+        """Return the stored vectors of `texts`, keyed by text."""
+        hashes = {text_hash(text): text for text in texts}
+        keys = list(hashes.keys())
+        found = {}
+        with self._lock:
+            conn = self._connect()
+            for i in range(0, len(keys), 500):
+                chunk = keys[i : i + 500]
+                rows = conn.execute(
+                    "SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN (%s)"
+                    % ",".join("?" * len(chunk)),
+                    [model] + chunk,
+                ).fetchall()
+                for hash, vector in rows:
+                    found[hashes[hash]] = np.frombuffer(vector, dtype=np.float32)
+        return found
+
+    def put_many(self, model: str, texts: list[str], vectors):
+        rows = [
+            (model, text_hash(text), np.asarray(vector, dtype=np.float32).tobytes())
+            for text, vector in zip(texts, vectors)
+        ]
+        with self._lock:
+            self._connect().executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)", rows
+            )
@@ -1,69 +1,414 @@
+import asyncio
+import concurrent.futures
+import functools
+import json
 import os
+import random
+import threading
+import time
+from collections import defaultdict, deque
 
 import openai
+import tiktoken
 from dotenv import load_dotenv
-from openai import AzureOpenAI
+from openai import AsyncAzureOpenAI, AsyncOpenAI
+
+from services.disk_cache import DiskCache, cache_key
+from services.metrics import METRICS
+from services.step_context import current_step
 
 load_dotenv("../../.env")
 
+# temperature=0, seed=0 で呼び出しているので、同じ入力に対する応答は再利用できる
+# LLM_CACHE=0 でキャッシュを無効化できる
+USE_CACHE = os.getenv("LLM_CACHE", "1") != "0"
+LLM_CACHE = DiskCache(
+    "llm",
+    max_bytes=int(os.getenv("LLM_CACHE_MAX_MB", "1024")) * 1024 * 1024,
+    max_age_days=float(os.getenv("LLM_CACHE_MAX_AGE_DAYS", "90")),
+)
+
+# プロバイダのレート制限 (未設定なら制限しない) と同時実行数の上限
+MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+REQUESTS_PER_MINUTE = float(os.getenv("LLM_RPM", "0")) or None
+TOKENS_PER_MINUTE = float(os.getenv("LLM_TPM", "0")) or None
+# 応答のトークン数は事前にわからないので、この値で見積もり、応答後に実際の値で精算する
+EXPECTED_COMPLETION_TOKENS = int(os.getenv("LLM_EXPECTED_COMPLETION_TOKENS", "512"))
+
+# 429・タイムアウト・5xxは指数バックオフ (ジッター付き) で再試行する
+MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "5"))
+BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "1"))
+BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "60"))
+# retry-after ヘッダの値もこの秒数までに抑える (誤った値で同時実行枠を長く塞がないように)
+BACKOFF_MAX_RETRY_AFTER = float(os.getenv("LLM_BACKOFF_MAX_RETRY_AFTER", "120"))
+# LLM_HEDGE=1 のとき、p95のレイテンシを超えたリクエストに同じリクエストを重ねて送る
+HEDGE = os.getenv("LLM_HEDGE", "0") != "0"
+HEDGE_MIN_SAMPLES = 20
+
+RETRYABLE_ERRORS = (
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+    openai.ConflictError,
+)
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding(model):
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except (KeyError, TypeError):
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        # エンコーディングを取得できない環境では文字数で多めに見積もる
+        print(f"Warning: could not load tiktoken encoding for {model}: {e}")
+        return None
+
+
+def count_tokens(text: str, model: str) -> int:
+    encoding = _encoding(model)
+    if encoding is None:
+        return len(text)
+    return len(encoding.encode(text))
+
+
+def estimate_tokens(messages: list[dict], model: str) -> int:
+    # メッセージごとに数トークンの区切りが入る
+    return sum(count_tokens(m.get("content") or "", model) + 4 for m in messages) + 3
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at `per_minute` units per minute."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.rate = per_minute / 60
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float):
+        amount = min(amount, self.capacity)
+        # ロックの取得順に払い出すので、大きなリクエストが後回しにされ続けることはない
+        async with self._lock:
+            self._refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= amount
+
+    def adjust(self, amount: float):
+        # 見積もりとの差分を精算する (マイナスになった分は以降の補充で返済される)
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+
+def retry_delay(error, attempt) -> float:
+    """
+    Return how long to wait before retrying after `error` (attempt starts at 0).
+
+    >>> class Response:
+    ...     headers = {"retry-after": "3600"}
+    >>> class Error:
+    ...     response = Response()
+    >>> retry_delay(Error(), 0) == BACKOFF_MAX_RETRY_AFTER
+    True
+    >>> Response.headers = {"retry-after-ms": "-500"}
+    >>> retry_delay(Error(), 0)
+    0.0
+    """
+    response = getattr(error, "response", None)
+    if response is not None:
+        try:
+            if "retry-after-ms" in response.headers:
+                delay = float(response.headers["retry-after-ms"]) / 1000
+                return max(0.0, min(BACKOFF_MAX_RETRY_AFTER, delay))
+            if "retry-after" in response.headers:
+                delay = float(response.headers["retry-after"])
+                return max(0.0, min(BACKOFF_MAX_RETRY_AFTER, delay))
+        except ValueError:
+            pass
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+
+
+class LLMEngine:
+    """
+    全ステップのLLM呼び出しを1つのイベントループで実行するエンジン。
+    非同期クライアントの接続、同時実行数、RPM/TPMの制限を全ステップで共有する。
+    同期コードからは submit() でコルーチンを投入し、concurrent.futures.Future で結果を受け取る。
+    """
+
+    def __init__(
+        self, max_concurrency, requests_per_minute=None, tokens_per_minute=None
+    ):
+        self.max_concurrency = max_concurrency
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._loop = None
+        self._start_lock = threading.Lock()
+        self._clients = {}
+        self._inflight = {}
+        self._latencies = defaultdict(lambda: deque(maxlen=200))
+
+    def _ensure_loop(self):
+        with self._start_lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=loop.run_forever, name="llm-engine", daemon=True
+                ).start()
+                self._semaphore = asyncio.Semaphore(self.max_concurrency)
+                self._rpm = None
+                if self.requests_per_minute:
+                    self._rpm = TokenBucket(self.requests_per_minute)
+                self._tpm = None
+                if self.tokens_per_minute:
+                    self._tpm = TokenBucket(self.tokens_per_minute)
+                self._loop = loop
+        return self._loop
+
+    def submit(self, coro) -> concurrent.futures.Future:
+        # イベントループのスレッドでも、投入したステップの名前で呼び出しを数える
+        step = current_step.get()
+
+        async def run():
+            current_step.set(step)
+            return await coro
+
+        return asyncio.run_coroutine_threadsafe(run(), self._ensure_loop())
+
+    def _client(self, provider):
+        if provider not in self._clients:
+            if provider == "azure":
+                self._clients[provider] = AsyncAzureOpenAI(
+                    api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+                    api_version="2024-02-01",
+                    azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+                    max_retries=0,
+                )
+            else:
+                # 再試行はエンジン側で行う
+                self._clients[provider] = AsyncOpenAI(max_retries=0)
+        return self._clients[provider]
+
+    async def chat(
+        self, provider, model, messages, response_format=None, validate=None
+    ):
+        """
+        Return the response to `messages`. Responses are cached only when
+        `validate(response)` accepts them, so that an unusable response is
+        requested again instead of being returned from the cache.
+        """
+        if not USE_CACHE:
+            return await self._request(provider, model, messages, response_format)
+        key = cache_key(provider, model, messages, response_format)
+        # SQLiteへのアクセスでイベントループ (他のリクエスト) を止めないよう、別スレッドで行う
+        loop = asyncio.get_running_loop()
+        cached = await loop.run_in_executor(None, LLM_CACHE.get, key)
+        if cached is not None:
+            METRICS.record_cache_hit(model)
+            return cached
+
+        # 同じリクエストが実行中であれば、その結果を待って共有する (single-flight)
+        task = self._inflight.get(key)
+        if task is not None:
+            METRICS.record_cache_hit(model)
+        else:
+            task = asyncio.ensure_future(
+                self._fetch(key, provider, model, messages, response_format, validate)
+            )
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._inflight.pop(key, None))
+            # 待っている呼び出し元がすべてキャンセルされても例外を握りつぶさない
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        # 呼び出し元がキャンセルされても、共有しているリクエスト自体は継続させる
+        return await asyncio.shield(task)
+
+    async def _fetch(self, key, provider, model, messages, response_format, validate):
+        result = await self._request(provider, model, messages, response_format)
+        if result is not None and _accepted(result, response_format, validate):
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, LLM_CACHE.set, key, result)
+        return result
+
+    async def _request(self, provider, model, messages, response_format):
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                return await self._hedged_call(
+                    provider, model, messages, response_format
+                )
+            except RETRYABLE_ERRORS as e:
+                if attempt == MAX_RETRIES:
+                    raise
+                METRICS.record_retry(model, e)
+                delay = retry_delay(e, attempt)
+                print(f"{type(e).__name__} from {model}, retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    def _hedge_threshold(self, model):
+        latencies = self._latencies[model]
+        if not HEDGE or len(latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        return sorted(latencies)[int(len(latencies) * 0.95)]
+
+    async def _hedged_call(self, provider, model, messages, response_format):
+        threshold = self._hedge_threshold(model)
+        if threshold is None:
+            return await self._call(provider, model, messages, response_format)
+        sent = asyncio.Event()
+        primary = asyncio.ensure_future(
+            self._call(provider, model, messages, response_format, sent)
+        )
+        # 待ち時間は送信してから数える (同時実行数やレート制限の順番待ちでは重ねて送らない)
+        waiting = asyncio.ensure_future(sent.wait())
+        await asyncio.wait({primary, waiting}, return_when=asyncio.FIRST_COMPLETED)
+        waiting.cancel()
+        if not primary.done():
+            await asyncio.wait({primary}, timeout=threshold)
+        if primary.done():
+            return primary.result()
+        if self._semaphore.locked():
+            # 空きがなければ重ねたリクエストも順番待ちになり、負荷を増やすだけになる
+            return await primary
+
+        METRICS.record_hedge(model)
+        hedge = asyncio.ensure_future(
+            self._call(provider, model, messages, response_format)
+        )
+        pending = {primary, hedge}
+        try:
+            # 先に成功した方の結果を使う (両方失敗したら後の方の例外を投げる)
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+            raise task.exception()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _call(self, provider, model, messages, response_format, sent=None):
+        estimated_tokens = estimate_tokens(messages, model) + EXPECTED_COMPLETION_TOKENS
+        async with self._semaphore:
+            if self._rpm:
+                await self._rpm.acquire(1)
+            if self._tpm:
+                await self._tpm.acquire(estimated_tokens)
+            if sent is not None:
+                sent.set()
+            started = time.monotonic()
+            response = await self._client(provider).chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=0,
+                n=1,
+                seed=0,
+                response_format=response_format,
+                timeout=30,
+            )
+            latency = time.monotonic() - started
+            self._latencies[model].append(latency)
+        usage = response.usage
+        METRICS.record_call(
+            model,
+            latency,
+            prompt_tokens=usage.prompt_tokens if usage else 0,
+            completion_tokens=usage.completion_tokens if usage else 0,
+        )
+        if self._tpm and usage is not None:
+            self._tpm.adjust(usage.total_tokens - estimated_tokens)
+        return response.choices[0].message.content
+
+
+def _accepted(response, response_format, validate) -> bool:
+    # 呼び出し元が使えない応答をキャッシュしない (再試行で同じ応答が返らないようにする)
+    try:
+        if validate is not None:
+            return bool(validate(response))
+        if response_format is not None:
+            json.loads(response)
+        return True
+    except Exception:
+        return False
+
+
+ENGINE = LLMEngine(MAX_CONCURRENCY, REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+
+
+def _submit(
+    provider, messages, model, is_json, validate=None
+) -> concurrent.futures.Future:
+    response_format = {"type": "json_object"} if is_json else None
+    return ENGINE.submit(
+        ENGINE.chat(provider, model, messages, response_format, validate)
+    )
+
+
+def submit_to_openai(
+    messages: list[dict],
+    model: str = "gpt-4",
+    is_json: bool = False,
+    validate=None,
+) -> concurrent.futures.Future:
+    return _submit("openai", messages, model, is_json, validate)
+
 
 def request_to_openai(
     messages: list[dict],
     model: str = "gpt-4",
     is_json: bool = False,
+    validate=None,
 ) -> dict:
-    openai.api_type = "openai"
-    response_format = {"type": "json_object"} if is_json else None
-    response = openai.chat.completions.create(
-        model=model,
-        messages=messages,
-        temperature=0,
-        n=1,
-        seed=0,
-        response_format=response_format,
-        timeout=30,
-    )
-    return response.choices[0].message.content
+    return submit_to_openai(messages, model, is_json, validate).result()
 
 
 def request_to_azure_openai(
     messages: list[dict],
     model: str = "gpt-4",
     is_json: bool = False,
+    validate=None,
 ) -> dict:
-    # Azure OpenAI設定
-    client = AzureOpenAI(
-        api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-        api_version="2024-02-01",
-        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-    )
-
-    if is_json:
-        response_format = {"type": "json_object"}
-    else:
-        response_format = None
-
-    response = client.chat.completions.create(
-        model=model,
-        messages=messages,
-        temperature=0,
-        n=1,
-        seed=0,
-        response_format=response_format,
-        timeout=30,
-    )
+    return _submit("azure", messages, model, is_json, validate).result()
 
-    return response.choices[0].message.content
 
-
-def request_to_chat_openai(
+def submit_to_chat_openai(
     messages: list[dict],
     model: str = "gpt-4o",
     is_json: bool = False,
-) -> dict:
+    validate=None,
+) -> concurrent.futures.Future:
+    """
+    Queue a request on the shared engine without waiting for its response.
+    The response is cached only if `validate(response)` accepts it (JSON
+    responses must at least parse).
+    """
     use_azure = os.getenv("USE_AZURE")
     if use_azure:
         model = os.getenv("AZURE_OPENAI_MODEL")
-        return request_to_azure_openai(messages, model, is_json)
+        return _submit("azure", messages, model, is_json, validate)
     else:
-        return request_to_openai(messages, model, is_json)
+        return _submit("openai", messages, model, is_json, validate)
+
+
+def request_to_chat_openai(
+    messages: list[dict],
+    model: str = "gpt-4o",
+    is_json: bool = False,
+    validate=None,
+) -> dict:
+    return submit_to_chat_openai(messages, model, is_json, validate).result()
+
+
+def evict_llm_cache():
+    if USE_CACHE:
+        LLM_CACHE.evict()
@@ -0,0 +1,189 @@
+"""Record LLM and embedding calls per step, and export them for dashboards."""
+
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+
+from services.step_context import current_step
+
+# 100万トークンあたりの料金 (USD, 入力・出力)。日付つきのモデル名は前方一致で探す
+# LLM_PRICES='{"my-model": [1.0, 2.0]}' で追加・上書きできる
+PRICES = {
+    "gpt-4o-mini": (0.15, 0.6),
+    "gpt-4o": (2.5, 10.0),
+    "gpt-4-turbo": (10.0, 30.0),
+    "gpt-4": (30.0, 60.0),
+    "gpt-3.5-turbo": (0.5, 1.5),
+    "text-embedding-3-small": (0.02, 0.0),
+    "text-embedding-3-large": (0.13, 0.0),
+    **{
+        model: tuple(price)
+        for model, price in json.loads(os.getenv("LLM_PRICES", "{}")).items()
+    },
+}
+
+
+def price(model):
+    matches = [m for m in PRICES if model and model.startswith(m)]
+    if not matches:
+        return None
+    return PRICES[max(matches, key=len)]
+
+
+def cost(model, prompt_tokens, completion_tokens) -> float | None:
+    p = price(model)
+    if p is None:
+        return None
+    return (prompt_tokens * p[0] + completion_tokens * p[1]) / 1_000_000
+
+
+class Metrics:
+    """
+    呼び出しごとの記録 (レイテンシ・トークン数・キャッシュ・再試行) をステップごとに保持する。
+    ステップは並行して実行されるので、記録は current_step のステップに紐づける。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = defaultdict(list)
+
+    def _record(self, **call):
+        call = {"time": time.time(), **call}
+        with self._lock:
+            self._calls[current_step.get()].append(call)
+
+    def record_call(self, model, latency, prompt_tokens=0, completion_tokens=0):
+        """An API call that returned, with its latency in seconds."""
+        self._record(
+            event="call",
+            model=model,
+            latency=latency,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            cost=cost(model, prompt_tokens, completion_tokens),
+        )
+
+    def record_cache_hit(self, model, count=1):
+        self._record(event="cache_hit", model=model, count=count)
+
+    def record_retry(self, model, error):
+        self._record(event="retry", model=model, error=type(error).__name__)
+
+    def record_hedge(self, model):
+        """A duplicate request sent because the first one was slower than p95."""
+        self._record(event="hedge", model=model)
+
+    def calls(self, step) -> list[dict]:
+        with self._lock:
+            return list(self._calls.get(step, []))
+
+    def summary(self, step) -> dict:
+        calls = self.calls(step)
+        api_calls = [c for c in calls if c["event"] == "call"]
+        latencies = [c["latency"] for c in api_calls]
+        costs = [c["cost"] for c in api_calls if c["cost"] is not None]
+        summary = {
+            "calls": len(api_calls),
+            "cache_hits": sum(c["count"] for c in calls if c["event"] == "cache_hit"),
+            "retries": sum(1 for c in calls if c["event"] == "retry"),
+            "hedges": sum(1 for c in calls if c["event"] == "hedge"),
+            "prompt_tokens": sum(c["prompt_tokens"] for c in api_calls),
+            "completion_tokens": sum(c["completion_tokens"] for c in api_calls),
+            # 料金表にないモデルの呼び出しは含まない
+            "cost_usd": round(sum(costs), 6),
+        }
+        if latencies:
+            summary["latency_p50"] = round(float(np.percentile(latencies, 50)), 3)
+            summary["latency_p95"] = round(float(np.percentile(latencies, 95)), 3)
+            summary["latency_max"] = round(max(latencies), 3)
+        return summary
+
+
+METRICS = Metrics()
+
+
+def append_jsonl(path, records):
+    with open(path, "a") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels: dict) -> str:
+    return ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+
+
+PROMETHEUS_METRICS = {
+    # 名前: (種類, 説明, ジョブの値を取り出す関数)
+    "pipeline_step_duration_seconds": (
+        "gauge",
+        "Wall time of the step",
+        lambda job: job["duration"],
+    ),
+    "pipeline_llm_calls": (
+        "gauge",
+        "API calls made by the step",
+        lambda job: job["metrics"]["calls"],
+    ),
+    "pipeline_llm_cache_hits": (
+        "gauge",
+        "Calls answered from a cache",
+        lambda job: job["metrics"]["cache_hits"],
+    ),
+    "pipeline_llm_retries": (
+        "gauge",
+        "Retried API calls",
+        lambda job: job["metrics"]["retries"],
+    ),
+    "pipeline_llm_prompt_tokens": (
+        "gauge",
+        "Prompt tokens sent by the step",
+        lambda job: job["metrics"]["prompt_tokens"],
+    ),
+    "pipeline_llm_completion_tokens": (
+        "gauge",
+        "Completion tokens received by the step",
+        lambda job: job["metrics"]["completion_tokens"],
+    ),
+    "pipeline_llm_tokens_per_comment": (
+        "gauge",
+        "Prompt and completion tokens per input comment",
+        lambda job: job["metrics"].get("tokens_per_comment"),
+    ),
+    "pipeline_llm_cost_usd": (
+        "gauge",
+        "Estimated cost of the API calls of the step",
+        lambda job: job["metrics"]["cost_usd"],
+    ),
+    "pipeline_llm_latency_p50_seconds": (
+        "gauge",
+        "Median latency of the API calls of the step",
+        lambda job: job["metrics"].get("latency_p50"),
+    ),
+    "pipeline_llm_latency_p95_seconds": (
+        "gauge",
+        "95th percentile latency of the API calls of the step",
+        lambda job: job["metrics"].get("latency_p95"),
+    ),
+}
+
+
+def prometheus_text(dataset, jobs) -> str:
+    """Metrics of completed `jobs` in the Prometheus text format."""
+    lines = []
+    for name, (kind, help, value) in PROMETHEUS_METRICS.items():
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        for job in jobs:
+            v = value(job)
+            if v is not None:
+                labels = _labels({"dataset": dataset, "step": job["step"]})
+                lines.append(f"{name}{{{labels}}} {v}")
+    return "\n".join(lines) + "\n"
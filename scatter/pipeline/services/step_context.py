@@ -0,0 +1,20 @@
+"""Track which step the running code belongs to when steps run concurrently."""
+
+import concurrent.futures
+import contextvars
+
+# 実行中のステップ名。進捗・統計・LLMの呼び出し回数をステップごとに記録するために使う
+current_step = contextvars.ContextVar("current_step", default=None)
+
+
+def step_executor(max_workers) -> concurrent.futures.ThreadPoolExecutor:
+    """
+    Thread pool whose workers run on behalf of the step that created it.
+    ThreadPoolExecutor does not copy context variables into its threads,
+    so the current step is set again in each worker.
+    """
+    return concurrent.futures.ThreadPoolExecutor(
+        max_workers=max_workers,
+        initializer=current_step.set,
+        initargs=(current_step.get(),),
+    )
@@ -1,23 +1,45 @@
 """Generate a convenient JSON output file."""
 
+import functools
+import gzip
 import json
-from collections import defaultdict
+import os
+import shutil
 from pathlib import Path
 
 import pandas as pd
 
+from services.artifacts import read_artifact, read_input
+from services.cluster_index import ClusterIndex
+
 ROOT_DIR = Path(__file__).parent.parent.parent.parent
 CONFIG_DIR = ROOT_DIR / "scatter" / "pipeline" / "configs"
 
 
-def create_custom_intro(config, total_sampled_num: int):
-    dataset = config["output_dir"]
-    args_path = f"outputs/{dataset}/args.csv"
-    comments = pd.read_csv(f"inputs/{config['input']}.csv")
-    result_path = f"outputs/{dataset}/result.json"
-
-    input_count = len(comments)
-    args_count = len(pd.read_csv(args_path))
+# レポート (next-app) が config から読むフィールド
+REPORT_CONFIG_FIELDS = [
+    "name",
+    "question",
+    "intro",
+    "description",
+    "translation",
+    "visualization",
+]
+# Appendixに表示するステップと、そこで使われるフィールド
+APPENDIX_STEPS = [
+    "extraction",
+    "embedding",
+    "clustering",
+    "labelling",
+    "takeaways",
+    "overview",
+]
+APPENDIX_FIELDS = ["model", "prompt", "source_code"]
+
+
+def create_custom_intro(
+    config, input_count: int, args_count: int, total_sampled_num: int
+) -> str:
     processed_num = min(input_count, config["extraction"]["limit"])
 
     print(f"Input count: {input_count}")
@@ -40,17 +62,102 @@ def create_custom_intro(config, total_sampled_num: int):
     custom_intro += (
         "一部、AIによる分析結果の中で、事実と異なる内容については削除を行った。"
     )
-    with open(result_path, "r") as f:
-        result = json.load(f)
-    result["config"]["intro"] = custom_intro
-    with open(result_path, "w") as f:
-        json.dump(result, f, indent=2)
+    return custom_intro
+
+
+def _report_config(config) -> dict:
+    report_config = {k: config[k] for k in REPORT_CONFIG_FIELDS if k in config}
+    for step in APPENDIX_STEPS:
+        if step in config:
+            report_config[step] = {
+                k: config[step][k] for k in APPENDIX_FIELDS if k in config[step]
+            }
+    return report_config
+
+
+def _compact(results) -> dict:
+    """Keep only what the report reads: plotted arguments, their comments and properties."""
+    plotted = [arg for c in results["clusters"] for arg in c["arguments"]]
+    comment_ids = {arg["comment_id"] for arg in plotted}
+    arg_ids = {arg["arg_id"] for arg in plotted}
+    return {
+        **results,
+        "comments": {
+            id: comment
+            for id, comment in results["comments"].items()
+            if id in comment_ids
+        },
+        "propertyMap": {
+            prop: {id: value for id, value in values.items() if id in arg_ids}
+            for prop, values in results["propertyMap"].items()
+        },
+        "config": _report_config(results["config"]),
+    }
+
+
+def _shards(results) -> dict[str, dict]:
+    """
+    Split compact results into a small index and one file per cluster.
+    index.json has everything but the arguments; each cluster file has the
+    arguments of the cluster with their comments and properties.
+    """
+    index = {k: v for k, v in results.items() if k not in ["comments", "propertyMap"]}
+    index["clusters"] = []
+    files = {}
+    for cluster in results["clusters"]:
+        name = f"cluster-{cluster['cluster_id']}.json"
+        index["clusters"].append(
+            {k: v for k, v in cluster.items() if k != "arguments"} | {"file": name}
+        )
+        comment_ids = [arg["comment_id"] for arg in cluster["arguments"]]
+        arg_ids = [arg["arg_id"] for arg in cluster["arguments"]]
+        files[name] = {
+            "arguments": cluster["arguments"],
+            "comments": {
+                id: results["comments"][id]
+                for id in comment_ids
+                if id in results["comments"]
+            },
+            "propertyMap": {
+                prop: {id: values[id] for id in arg_ids if id in values}
+                for prop, values in results["propertyMap"].items()
+            },
+        }
+    files["index.json"] = index
+    return files
+
+
+@functools.lru_cache(maxsize=None)
+def _brotli():
+    try:
+        import brotli
+    except ImportError:
+        print("Warning: brotli is not installed, skipping .br files")
+        return None
+    return brotli
+
+
+def _write_json(path, data, compact: bool, compression: list[str]):
+    if compact:
+        encoded = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+    else:
+        encoded = json.dumps(data, indent=2)
+    encoded = encoded.encode("utf-8")
+    with open(path, "wb") as f:
+        f.write(encoded)
+    # 配信時にそのまま使えるように、圧縮済みのファイルを隣に置く
+    if "gzip" in compression:
+        with open(f"{path}.gz", "wb") as f:
+            f.write(gzip.compress(encoded, compresslevel=9, mtime=0))
+    if "brotli" in compression and _brotli() is not None:
+        with open(f"{path}.br", "wb") as f:
+            f.write(_brotli().compress(encoded))
 
 
 def _build_property_map(
     arguments: pd.DataFrame, property_columns: list[str]
 ) -> dict[str, dict[str, str]]:
-    property_map = defaultdict(dict)
+    property_map = {}
 
     # 指定された property_columns が arguments に存在するかチェック
     missing_cols = [col for col in property_columns if col not in arguments.columns]
@@ -61,12 +168,67 @@ def _build_property_map(
         )
 
     for prop in property_columns:
-        for arg_id, row in arguments.iterrows():
-            # LLMによるcategory classificationがうまく行かず、NaNの場合はNoneにする
-            property_map[prop][arg_id] = row[prop] if not pd.isna(row[prop]) else None
+        # LLMによるcategory classificationがうまく行かず、NaNの場合はNoneにする
+        values = arguments[prop].astype(object)
+        values = values.where(values.notna(), None)
+        property_map[prop] = dict(zip(arguments.index, values.tolist()))
     return property_map
 
 
+def _visible_comments(
+    comments: pd.DataFrame,
+    useful_comment_ids,
+    hidden_properties_map: dict[str, list[str]],
+) -> dict[str, dict]:
+    visible = comments["comment-id"].isin(useful_comment_ids)
+    for prop, hidden_values in hidden_properties_map.items():
+        visible &= ~comments[prop].isin(hidden_values)
+    rows = comments[visible]
+    result = {}
+    for id, body in zip(rows["comment-id"].tolist(), rows["comment-body"].tolist()):
+        result[str(id)] = {"comment": body}
+    return result
+
+
+def _sampled_arguments(rows: pd.DataFrame, arguments: pd.DataFrame) -> list[dict]:
+    """Build the argument objects of result.json for sampled rows of clusters.csv."""
+    positions = arguments.index.get_indexer(rows["arg-id"])
+    found = positions >= 0
+    for arg_id in rows.loc[~found, "arg-id"]:
+        print("Error with arg_id:", arg_id)
+    rows = rows[found]
+    matched = arguments.iloc[positions[found]]
+    return [
+        {
+            "arg_id": arg_id,
+            "argument": argument,
+            "comment_id": str(comment_id),
+            "x": float(x),
+            "y": float(y),
+            "p": float(p),
+        }
+        for arg_id, argument, comment_id, x, y, p in zip(
+            rows["arg-id"],
+            matched["argument"],
+            matched["comment-id"],
+            rows["x"],
+            rows["y"],
+            rows["probability"],
+        )
+    ]
+
+
+def _add_representative_bonus(index: ClusterIndex, labels: pd.DataFrame):
+    # labelling で選ばれた代表意見が所属確率の高い順で先頭に来るように100を加える
+    if "representatives" not in labels.columns:
+        # 以前のバージョンの labelling は clusters.csv に加算済み
+        return
+    # 以前のバージョンで加算された clusters.csv が残っていても二重に加算しない
+    index.table["probability"] = index.table["probability"].values % 100
+    for representatives in labels["representatives"].dropna():
+        index.add(representatives.split(","), "probability", 100)
+
+
 def aggregation(config):
     path = f"outputs/{config['output_dir']}/result.json"
     total_sampling_num = config["aggregation"]["sampling_num"]
@@ -81,25 +243,17 @@ def aggregation(config):
         "config": config,
     }
 
-    arguments = pd.read_csv(f"outputs/{config['output_dir']}/args.csv")
+    arguments = read_artifact(config, "args")
     arguments.set_index("arg-id", inplace=True)
-    comments = pd.read_csv(f"inputs/{config['input']}.csv")
+    comments = read_input(config)
     hidden_properties_map: dict[str, list[str]] = config["aggregation"][
         "hidden_properties"
     ]
 
-    useful_comment_ids = set(arguments["comment-id"].values)
-    for _, row in comments.iterrows():
-        id = row["comment-id"]
-        if id in useful_comment_ids:
-            res = {"comment": row["comment-body"]}
-            should_skip = any(
-                row[prop] in hidden_values
-                for prop, hidden_values in hidden_properties_map.items()
-            )
-            if should_skip:
-                continue
-            results["comments"][str(id)] = res
+    useful_comment_ids = arguments["comment-id"].unique()
+    results["comments"] = _visible_comments(
+        comments, useful_comment_ids, hidden_properties_map
+    )
 
     languages = list(config.get("translation", {}).get("languages", []))
     if len(languages) > 0:
@@ -107,10 +261,12 @@ def aggregation(config):
             translations = f.read()
         results["translations"] = json.loads(translations)
 
-    clusters = pd.read_csv(f"outputs/{config['output_dir']}/clusters.csv")
-    labels = pd.read_csv(f"outputs/{config['output_dir']}/labels.csv")
-    takeaways = pd.read_csv(f"outputs/{config['output_dir']}/takeaways.csv")
+    clusters = read_artifact(config, "clusters")
+    labels = read_artifact(config, "labels")
+    takeaways = read_artifact(config, "takeaways")
     takeaways.set_index("cluster-id", inplace=True)
+    index = ClusterIndex(clusters)
+    _add_representative_bonus(index, labels)
 
     print("relevant clusters score")
     print(clusters.sort_values(by="probability", ascending=False).head(10))
@@ -129,11 +285,8 @@ def aggregation(config):
     sample_rate = min(total_sampling_num / arguments_num, 1)
     total_sampled_num = 0
 
-    sampled_comment_ids = []
-    for _, row in labels.iterrows():
-        cid = row["cluster-id"]
-        label = row["label"]
-        arg_rows = clusters[clusters["cluster-id"] == cid]
+    for cid, label in zip(labels["cluster-id"], labels["label"]):
+        arg_rows = index.rows(cid)
         c_arg_num = len(arg_rows)
         sampling_num = int(c_arg_num * sample_rate)
 
@@ -144,40 +297,10 @@ def aggregation(config):
             continue
         print(f"sampling num: {sampling_num}", c_arg_num, sample_rate)
         total_sampled_num += sampling_num
-        arguments_in_cluster = []
 
         # pickup top 5 for representative comments
         sorted_rows = arg_rows.sort_values(by="probability", ascending=False)
-        top_5 = sorted_rows.head(5)
-        for _, arg_row in top_5.head(sampling_num).iterrows():
-            arg_id = arg_row["arg-id"]
-            try:
-                argument = arguments.loc[arg_id]["argument"]
-                comment_id = arguments.loc[arg_id]["comment-id"]
-                x = float(arg_row["x"])
-                y = float(arg_row["y"])
-                p = float(arg_row["probability"])
-                obj = {
-                    "arg_id": arg_id,
-                    "argument": argument,
-                    "comment_id": str(comment_id),
-                    "x": x,
-                    "y": y,
-                    "p": p,
-                }
-                sampled_comment_ids.append(comment_id)
-                arguments_in_cluster.append(obj)
-            except:
-                print("Error with arg_id:", arg_id)
-
-        results["clusters"].append(
-            {
-                "cluster": label,
-                "cluster_id": str(cid),
-                "takeaways": takeaways.loc[cid]["takeaways"],
-                "arguments": arguments_in_cluster,
-            }
-        )
+        top_5 = sorted_rows.head(5).head(sampling_num)
 
         # random sampling
         remaining = sorted_rows.iloc[5:]
@@ -186,26 +309,16 @@ def aggregation(config):
             n=min(remaining_sample_size, len(remaining)), random_state=42
         )
 
-        for _, arg_row in random_sample.iterrows():
-            arg_id = arg_row["arg-id"]
-            try:
-                argument = arguments.loc[arg_id]["argument"]
-                comment_id = arguments.loc[arg_id]["comment-id"]
-                x = float(arg_row["x"])
-                y = float(arg_row["y"])
-                p = float(arg_row["probability"])
-                obj = {
-                    "arg_id": arg_id,
-                    "argument": argument,
-                    "comment_id": str(comment_id),
-                    "x": x,
-                    "y": y,
-                    "p": p,
-                }
-                sampled_comment_ids.append(comment_id)
-                arguments_in_cluster.append(obj)
-            except:
-                print("Error with arg_id:", arg_id)
+        results["clusters"].append(
+            {
+                "cluster": label,
+                "cluster_id": str(cid),
+                "takeaways": takeaways.loc[cid]["takeaways"],
+                "arguments": _sampled_arguments(
+                    pd.concat([top_5, random_sample]), arguments
+                ),
+            }
+        )
 
     # 属性情報のカラムは、元データに対して指定したカラムとclassificationするカテゴリを合わせたもの
     property_columns = list(hidden_properties_map.keys()) + list(
@@ -213,7 +326,21 @@ def aggregation(config):
     )
     results["propertyMap"] = _build_property_map(arguments, property_columns)
 
-    with open(path, "w") as file:
-        json.dump(results, file, indent=2)
-
-    create_custom_intro(config, total_sampled_num)
+    custom_intro = create_custom_intro(
+        config, len(comments), arguments_num, total_sampled_num
+    )
+    results["config"] = {**config, "intro": custom_intro}
+
+    options = config["aggregation"]
+    compression = options["compression"]
+    if options["compact"]:
+        results = _compact(results)
+    _write_json(path, results, options["compact"], compression)
+
+    if options["shards"]:
+        shards_dir = f"outputs/{config['output_dir']}/result"
+        # クラスタ数が変わった場合に古いファイルが残らないように作り直す
+        shutil.rmtree(shards_dir, ignore_errors=True)
+        os.makedirs(shards_dir)
+        for name, data in _shards(results).items():
+            _write_json(f"{shards_dir}/{name}", data, options["compact"], compression)
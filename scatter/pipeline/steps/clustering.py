@@ -1,11 +1,18 @@
 """Cluster the arguments using UMAP + HDBSCAN and GPT-4."""
 
+import hashlib
+import json
+import os
+import pickle
 from importlib import import_module
 
 import numpy as np
 import pandas as pd
 from janome.tokenizer import Tokenizer
 
+from services.artifacts import read_artifact, write_artifact
+from utils import incremental_update, update_step_stats
+
 STOP_WORDS = [
     "の",
     "に",
@@ -35,25 +42,59 @@ TOKENIZER = Tokenizer()
 
 def clustering(config):
     dataset = config["output_dir"]
-    path = f"outputs/{dataset}/clusters.csv"
-    arguments_df = pd.read_csv(f"outputs/{dataset}/args.csv")
+    arguments_df = read_artifact(
+        config, "args", columns=["arg-id", "comment-id", "argument"]
+    )
     arguments_array = arguments_df["argument"].values
 
     embeddings_df = pd.read_pickle(f"outputs/{dataset}/embeddings.pkl")
     embeddings_array = np.asarray(embeddings_df["embedding"].values.tolist())
     clusters = config["clustering"]["clusters"]
+    metadatas = {
+        "arg-id": arguments_df["arg-id"].values,
+        "comment-id": arguments_df["comment-id"].values,
+    }
+    projection_cache = f"outputs/{dataset}/umap_projection.npz"
+    model_path = f"outputs/{dataset}/umap_model.pkl"
 
-    result = cluster_embeddings(
-        docs=arguments_array,
-        embeddings=embeddings_array,
-        metadatas={
-            "arg-id": arguments_df["arg-id"].values,
-            "comment-id": arguments_df["comment-id"].values,
-        },
-        min_cluster_size=clusters,
-        n_topics=clusters,
-    )
-    result.to_csv(path, index=False)
+    # --incremental: 新しい意見だけを既存の射影とクラスタに配置する
+    # (抽出と埋め込みも差分だけで行われ、以前の意見の埋め込みが変わっていない場合に限る)
+    if incremental_update(config, "clustering", upstream="embedding"):
+        result = assign_new_arguments(
+            previous=read_artifact(config, "clusters"),
+            arg_ids=metadatas["arg-id"],
+            embeddings=embeddings_array,
+            model_path=model_path,
+            refit_threshold=config["clustering"]["refit_threshold"],
+        )
+        if result is not None:
+            update_step_stats(config, {"incremental": True})
+            write_artifact(config, "clusters", result)
+            return
+
+    # 件数が多い場合はサンプルで学習し、残りの点は割り当てるだけにする
+    if len(embeddings_array) > config["clustering"]["large_n_threshold"]:
+        result = cluster_embeddings_large(
+            embeddings=embeddings_array,
+            metadatas=metadatas,
+            min_cluster_size=clusters,
+            n_topics=clusters,
+            sample_size=config["clustering"]["fit_sample_size"],
+            projection_cache=projection_cache,
+            model_path=model_path,
+        )
+    else:
+        result = cluster_embeddings(
+            docs=arguments_array,
+            embeddings=embeddings_array,
+            metadatas=metadatas,
+            min_cluster_size=clusters,
+            n_topics=clusters,
+            projection_cache=projection_cache,
+            model_path=model_path,
+        )
+    update_step_stats(config, {"incremental": False})
+    write_artifact(config, "clusters", result)
 
 
 def tokenize_japanese(text):
@@ -64,6 +105,162 @@ def tokenize_japanese(text):
     ]
 
 
+class PrecomputedProjection:
+    """
+    Stand-in for the UMAP model given to BERTopic, returning a projection
+    computed beforehand so that UMAP is only fitted once.
+    """
+
+    def __init__(self, projection):
+        self.projection = projection
+
+    def fit(self, X, y=None):
+        return self
+
+    def transform(self, X):
+        return self.projection
+
+
+def umap_projection(
+    embeddings, umap_params, cache_path=None, fit_rows=None, model_path=None
+):
+    """
+    Project the embeddings with UMAP. When `fit_rows` is given, UMAP is only
+    fitted on those rows and the other rows are projected with `transform`.
+    The fitted model is saved to `model_path` (if given) so that arguments
+    added later can be projected with `assign_new_arguments`.
+    """
+    # 埋め込みとUMAPのパラメータが同じなら、前回の射影を再利用する
+    hash = hashlib.sha256(np.ascontiguousarray(embeddings))
+    hash.update(json.dumps(umap_params, sort_keys=True).encode("utf-8"))
+    if fit_rows is not None:
+        hash.update(np.ascontiguousarray(fit_rows))
+    key = hash.hexdigest()
+    if cache_path and os.path.exists(cache_path):
+        cached = np.load(cache_path)
+        if str(cached["key"]) == key and _saved_model_key(model_path) in (None, key):
+            print("Reusing cached UMAP projection")
+            return cached["projection"]
+
+    UMAP = import_module("umap").UMAP
+    if fit_rows is None:
+        umap_model = UMAP(**umap_params)
+        projection = umap_model.fit_transform(embeddings)
+    else:
+        umap_model = UMAP(**umap_params).fit(embeddings[fit_rows])
+        projection = np.empty((len(embeddings), umap_params["n_components"]))
+        projection[fit_rows] = umap_model.embedding_
+        rest = np.setdiff1d(np.arange(len(embeddings)), fit_rows)
+        for chunk in _chunks(rest):
+            projection[chunk] = umap_model.transform(embeddings[chunk])
+    if cache_path:
+        np.savez(cache_path, key=key, projection=projection)
+    if model_path:
+        # 先頭のヘッダだけを読めば、大きなモデル本体を読み込まずに照合できる
+        with open(model_path, "wb") as f:
+            pickle.dump({"key": key, "arguments": len(embeddings)}, f)
+            pickle.dump(umap_model, f)
+    return projection
+
+
+def _saved_model_key(model_path):
+    # モデルの保存先が指定されていないときは None、保存されていなければ空文字列
+    if not model_path:
+        return None
+    if not os.path.exists(model_path):
+        return ""
+    with open(model_path, "rb") as f:
+        return pickle.load(f)["key"]
+
+
+def assign_new_arguments(
+    previous, arg_ids, embeddings, model_path, refit_threshold, n_neighbors=10
+):
+    """
+    Place the arguments missing from the previous clusters into the existing
+    projection and clusters: they are projected with the saved UMAP model and
+    get the most common cluster of their nearest neighbours. Their
+    probability is the share of neighbours in that cluster times the mean
+    HDBSCAN probability of those neighbours.
+    Returns None when the clusters should be fitted again instead: no saved
+    model, or more than `refit_threshold` of the arguments were not part of
+    the last fit.
+    """
+    if not os.path.exists(model_path):
+        print("No saved UMAP model, fitting the clusters again")
+        return None
+    with open(model_path, "rb") as f:
+        header = pickle.load(f)
+        # 前回の学習以降に追加された意見の割合が閾値を超えたら、全体を学習し直す
+        drift = 1 - header["arguments"] / len(arg_ids)
+        if drift > refit_threshold:
+            print(
+                f"{drift:.0%} of the arguments were added since the clusters "
+                "were fitted, fitting them again"
+            )
+            return None
+        umap_model = pickle.load(f)
+
+    previous = previous.set_index("arg-id")
+    # 削除された意見は取り除き、既存の意見の座標・クラスタ・確率はそのまま使う
+    known = pd.Index(arg_ids).isin(previous.index)
+    if not known.any():
+        return None
+    new_rows = np.flatnonzero(~known)
+    print(f"Assigning {len(new_rows)} new arguments to the existing clusters")
+    result = previous.reindex(arg_ids).reset_index()
+    if len(new_rows) > 0:
+        NearestNeighbors = import_module("sklearn.neighbors").NearestNeighbors
+        coordinates = result.loc[known, ["x", "y"]].values
+        known_clusters = result.loc[known, "cluster-id"].values
+        # 以前のバージョンの labelling が代表意見に加算した100を除く
+        known_probabilities = result.loc[known, "probability"].values % 100
+        classes = np.unique(known_clusters)
+        k = min(n_neighbors, len(coordinates))
+        neighbours = NearestNeighbors(n_neighbors=k).fit(coordinates)
+        for chunk in _chunks(new_rows):
+            projected = umap_model.transform(embeddings[chunk])
+            _, indices = neighbours.kneighbors(projected[:, :2])
+            clusters = known_clusters[indices]
+            votes = (clusters[:, :, None] == classes).sum(axis=1)
+            winner = classes[votes.argmax(axis=1)]
+            in_winner = clusters == winner[:, None]
+            # 得票率だけでは多くが1.0になり、代表意見の選択で既存の意見より優先されてしまう。
+            # 同じクラスタの近傍の所属確率の平均を掛けて、HDBSCANの確率の尺度にそろえる
+            mean_probability = (known_probabilities[indices] * in_winner).sum(
+                axis=1
+            ) / in_winner.sum(axis=1)
+            result.loc[chunk, ["x", "y"]] = projected[:, :2]
+            result.loc[chunk, "cluster-id"] = winner
+            result.loc[chunk, "probability"] = votes.max(axis=1) / k * mean_probability
+        result["cluster-id"] = result["cluster-id"].astype(int)
+    return result
+
+
+def _chunks(rows, chunk_size=50000):
+    return [rows[i : i + chunk_size] for i in range(0, len(rows), chunk_size)]
+
+
+def stratified_sample(embeddings, sample_size, n_strata=100, random_state=42):
+    """
+    Sample rows proportionally from strata found by mini-batch k-means, so
+    that small regions of the embedding space are still represented.
+    """
+    if sample_size >= len(embeddings):
+        return np.arange(len(embeddings))
+    MiniBatchKMeans = import_module("sklearn.cluster").MiniBatchKMeans
+    strata = MiniBatchKMeans(
+        n_clusters=n_strata, batch_size=4096, n_init=3, random_state=random_state
+    ).fit_predict(embeddings)
+    rng = np.random.default_rng(random_state)
+    sample = []
+    for stratum in np.unique(strata):
+        rows = np.flatnonzero(strata == stratum)
+        n = max(1, round(len(rows) * sample_size / len(embeddings)))
+        sample.append(rng.choice(rows, size=min(n, len(rows)), replace=False))
+    return np.sort(np.concatenate(sample))
+
+
 def cluster_embeddings(
     docs,
     embeddings,
@@ -71,19 +268,24 @@ def cluster_embeddings(
     min_cluster_size=2,
     n_components=2,
     n_topics=6,
+    projection_cache=None,
+    model_path=None,
 ):
     # (!) we import the following modules dynamically for a reason
     # (they are slow to load and not required for all pipelines)
     SpectralClustering = import_module("sklearn.cluster").SpectralClustering
     HDBSCAN = import_module("hdbscan").HDBSCAN
-    UMAP = import_module("umap").UMAP
     CountVectorizer = import_module("sklearn.feature_extraction.text").CountVectorizer
     BERTopic = import_module("bertopic").BERTopic
 
-    umap_model = UMAP(
-        random_state=42,
-        n_components=n_components,
+    # UMAPは一度だけ学習し、BERTopicとスペクトラルクラスタリングの両方で使う
+    umap_embeds = umap_projection(
+        embeddings,
+        {"random_state": 42, "n_components": n_components},
+        projection_cache,
+        model_path=model_path,
     )
+    umap_model = PrecomputedProjection(umap_embeds)
     hdbscan_model = HDBSCAN(min_cluster_size=min_cluster_size)
 
     vectorizer_model = CountVectorizer(tokenizer=tokenize_japanese)
@@ -105,7 +307,6 @@ def cluster_embeddings(
         n_neighbors=n_neighbors,  # Use the modified n_neighbors
         random_state=42,
     )
-    umap_embeds = umap_model.fit_transform(embeddings)
     cluster_labels = spectral_model.fit_predict(umap_embeds)
 
     result = topic_model.get_document_info(
@@ -122,3 +323,71 @@ def cluster_embeddings(
     result["cluster-id"] = cluster_labels
 
     return result
+
+
+def cluster_embeddings_large(
+    embeddings,
+    metadatas,
+    min_cluster_size=2,
+    n_components=2,
+    n_topics=6,
+    sample_size=50000,
+    projection_cache=None,
+    model_path=None,
+):
+    """
+    Scalable variant of `cluster_embeddings` for very large datasets.
+    UMAP, HDBSCAN and spectral clustering are fitted on a stratified sample,
+    and the remaining points are assigned in vectorized chunks
+    (UMAP transform, HDBSCAN approximate_predict, nearest neighbours).
+    BERTopic is skipped: only the HDBSCAN membership probability is used.
+    """
+    SpectralClustering = import_module("sklearn.cluster").SpectralClustering
+    KNeighborsClassifier = import_module("sklearn.neighbors").KNeighborsClassifier
+    hdbscan = import_module("hdbscan")
+
+    sample = stratified_sample(embeddings, sample_size)
+    rest = np.setdiff1d(np.arange(len(embeddings)), sample)
+    print(f"Fitting clusters on {len(sample)} of {len(embeddings)} arguments")
+
+    umap_embeds = umap_projection(
+        embeddings,
+        {"random_state": 42, "n_components": n_components},
+        projection_cache,
+        fit_rows=sample,
+        model_path=model_path,
+    )
+    sample_embeds = umap_embeds[sample]
+
+    hdbscan_model = hdbscan.HDBSCAN(
+        min_cluster_size=min_cluster_size, prediction_data=True
+    ).fit(sample_embeds)
+    probabilities = np.empty(len(embeddings))
+    probabilities[sample] = hdbscan_model.probabilities_
+
+    spectral_model = SpectralClustering(
+        n_clusters=n_topics,
+        affinity="nearest_neighbors",
+        n_neighbors=min(len(sample) - 1, 10),
+        random_state=42,
+    )
+    cluster_labels = np.empty(len(embeddings), dtype=int)
+    cluster_labels[sample] = spectral_model.fit_predict(sample_embeds)
+
+    neighbours = KNeighborsClassifier(n_neighbors=10).fit(
+        sample_embeds, cluster_labels[sample]
+    )
+    for chunk in _chunks(rest):
+        cluster_labels[chunk] = neighbours.predict(umap_embeds[chunk])
+        _, strengths = hdbscan.approximate_predict(hdbscan_model, umap_embeds[chunk])
+        probabilities[chunk] = strengths
+
+    return pd.DataFrame(
+        {
+            "arg-id": metadatas["arg-id"],
+            "x": umap_embeds[:, 0],
+            "y": umap_embeds[:, 1],
+            "probability": probabilities,
+            "cluster-id": cluster_labels,
+        }
+    )
@@ -1,11 +1,20 @@
 import os
+import time
 
+import numpy as np
 import pandas as pd
 from dotenv import load_dotenv
 from langchain.embeddings import OpenAIEmbeddings
 from langchain_openai import AzureOpenAIEmbeddings
 from tqdm import tqdm
 
+from services.artifacts import read_artifact
+from services.embedding_store import EmbeddingStore
+from services.llm import count_tokens
+from services.metrics import METRICS
+from services.step_context import step_executor
+from utils import incremental_update, update_step_stats
+
 load_dotenv("../../.env")
 
 EMBDDING_MODELS = [
@@ -13,6 +22,9 @@ EMBDDING_MODELS = [
     "text-embedding-3-small",
 ]
 
+# 1リクエストに含められる入力数の上限 (OpenAI API)
+MAX_BATCH_SIZE = 2048
+
 
 def _validate_model(model):
     if model not in EMBDDING_MODELS:
@@ -29,26 +41,142 @@ def embed_by_openai(args, model):
         ).embed_documents(args)
     else:
         _validate_model(model)
-        embeds = OpenAIEmbeddings(model=model).embed_documents(args)
+        embeds = OpenAIEmbeddings(model=model, chunk_size=MAX_BATCH_SIZE).embed_documents(
+            args
+        )
     return embeds
 
 
+def embed_locally(texts, model_path, batch_size, processes=None):
+    """
+    Embed `texts` on the CPU with the sentence-transformers model saved in
+    `model_path`, in `processes` worker processes (all cores by default).
+    Returns unit vectors, like the OpenAI embeddings.
+    """
+    # (!) sentence-transformers (torch) は読み込みが遅く、OpenAI を使う場合は不要なのでここで読み込む
+    try:
+        from sentence_transformers import SentenceTransformer
+    except ImportError as e:
+        raise RuntimeError(
+            "The local embedding backend needs the optional sentence-transformers "
+            "package: pip install sentence-transformers"
+        ) from e
+    model = SentenceTransformer(model_path, device="cpu")
+    processes = processes or os.cpu_count() or 1
+
+    # 長さ順に並べてから分割すると、同じバッチの文の長さが揃ってパディングが減る
+    order = np.argsort([len(text) for text in texts], kind="stable")
+    sorted_texts = [texts[i] for i in order]
+    if processes > 1 and len(texts) > batch_size * processes:
+        pool = model.start_multi_process_pool(target_devices=["cpu"] * processes)
+        try:
+            embeds = model.encode_multi_process(sorted_texts, pool, batch_size=batch_size)
+        finally:
+            model.stop_multi_process_pool(pool)
+    else:
+        embeds = model.encode(sorted_texts, batch_size=batch_size, convert_to_numpy=True)
+
+    embeds = np.asarray(embeds, dtype=np.float32).reshape(len(texts), -1)
+    result = np.empty_like(embeds)
+    result[order] = embeds
+    norms = np.linalg.norm(result, axis=1, keepdims=True)
+    return result / np.where(norms == 0, 1, norms)
+
+
+def local_model_key(model_path):
+    # 埋め込みの保存先では、ローカルのモデルをパスで区別する
+    return f"local:{os.path.abspath(model_path)}"
+
+
+def pack_batches(texts, model, batch_tokens):
+    batches = []
+    batch = []
+    tokens = 0
+    for text in texts:
+        n = count_tokens(text, model)
+        if batch and (tokens + n > batch_tokens or len(batch) >= MAX_BATCH_SIZE):
+            batches.append(batch)
+            batch = []
+            tokens = 0
+        batch.append(text)
+        tokens += n
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def embed_missing_by_openai(missing, model, config, store, vectors):
+    # トークン数の上限に収まるようにバッチを詰め、複数のバッチを並行して送る
+    batches = pack_batches(missing, model, config["embedding"]["batch_tokens"])
+
+    def embed_batch(batch):
+        started = time.monotonic()
+        embeds = np.asarray(embed_by_openai(batch, model), dtype=np.float32)
+        METRICS.record_call(
+            model,
+            time.monotonic() - started,
+            prompt_tokens=sum(count_tokens(text, model) for text in batch),
+        )
+        store.put_many(model, batch, embeds)
+        return embeds
+
+    workers = config["embedding"]["workers"]
+    with step_executor(workers) as executor:
+        for batch, embeds in tqdm(
+            zip(batches, executor.map(embed_batch, batches)), total=len(batches)
+        ):
+            vectors.update(zip(batch, embeds))
+
+
 def embedding(config):
-    model = config["embedding"]["model"]
+    backend = config["embedding"]["backend"]
+    if backend == "local":
+        model_path = config["embedding"]["model_path"]
+        if not model_path or not os.path.isdir(model_path):
+            raise RuntimeError(
+                f"embedding.model_path must be a local model directory, got: {model_path}"
+            )
+        model = local_model_key(model_path)
+    elif backend == "openai":
+        model = config["embedding"]["model"]
+    else:
+        raise RuntimeError(
+            f"Invalid embedding backend: {backend}, available backends: ['openai', 'local']"
+        )
 
     dataset = config["output_dir"]
     path = f"outputs/{dataset}/embeddings.pkl"
-    arguments = pd.read_csv(f"outputs/{dataset}/args.csv")
-    embeddings = []
-    batch_size = 1000
-    for i in tqdm(range(0, len(arguments), batch_size)):
-        args = arguments["argument"].tolist()[i: i + batch_size]
-        embeds = embed_by_openai(args, model)
-        embeddings.extend(embeds)
+    # 以前の意見の埋め込みが変わらないのは、抽出が差分だけで行われ、モデルも同じ場合だけ。
+    # そうでなければ clustering は以前の座標とクラスタを使わずに作り直す
+    incremental = incremental_update(config, "embedding", upstream="extraction")
+    arguments = read_artifact(config, "args", columns=["arg-id", "argument"])
+    texts = arguments["argument"].tolist()
+
+    # 過去の実行(他のデータセットを含む)で埋め込み済みのテキストは再利用する
+    store = EmbeddingStore()
+    vectors = store.get_many(model, texts)
+    missing = [text for text in dict.fromkeys(texts) if text not in vectors]
+    print(f"Embeddings to compute: {len(missing)}/{len(texts)}")
+    METRICS.record_cache_hit(model, count=len(vectors))
+
+    if backend == "local":
+        if missing:
+            embeds = embed_locally(
+                missing,
+                model_path,
+                config["embedding"]["local_batch_size"],
+                config["embedding"]["processes"],
+            )
+            store.put_many(model, missing, embeds)
+            vectors.update(zip(missing, embeds))
+    else:
+        embed_missing_by_openai(missing, model, config, store, vectors)
+
     df = pd.DataFrame(
-        [
-            {"arg-id": arguments.iloc[i]["arg-id"], "embedding": e}
-            for i, e in enumerate(embeddings)
-        ]
+        {
+            "arg-id": arguments["arg-id"].values,
+            "embedding": [vectors[text].tolist() for text in texts],
+        }
     )
     df.to_pickle(path)
+    update_step_stats(config, {"incremental": incremental})
@@ -1,18 +1,30 @@
 import concurrent.futures
 import json
 import logging
+import os
 import re
+from collections import Counter, deque
 
 import pandas as pd
 from tqdm import tqdm
 
+from services.artifacts import read_artifact, read_input, write_artifact
 from services.category_classification import classify_args
-from services.llm import request_to_chat_openai
+from services.disk_cache import cache_key
+from services.llm import RETRYABLE_ERRORS, submit_to_chat_openai
 from services.parse_json_list import parse_response
 
-from utils import update_progress
+from utils import (
+    file_hash,
+    incremental_update,
+    retry_ids,
+    update_progress,
+    update_step_stats,
+)
 
 COMMA_AND_SPACE_AND_RIGHT_BRACKET = re.compile(r",\s*(\])")
+# 意見のリストとして読めない応答が続いたときに、コメントを諦めるまでの問い合わせ回数
+PARSE_ATTEMPTS = 2
 
 
 def _validate_property_columns(
@@ -26,8 +38,7 @@ def _validate_property_columns(
 
 def extraction(config):
     dataset = config["output_dir"]
-    path = f"outputs/{dataset}/args.csv"
-    comments = pd.read_csv(f"inputs/{config['input']}.csv")
+    comments = read_input(config)
 
     model = config["extraction"]["model"]
     prompt = config["extraction"]["prompt"]
@@ -46,94 +57,244 @@ def extraction(config):
         raise e
     comment_ids = (comments["comment-id"].values)[:limit]
     comments.set_index("comment-id", inplace=True)
-    results = pd.DataFrame()
+
+    # --incremental: 前回の args.csv にまだ含まれていないコメントだけを抽出する
+    # (意見が1件も抽出されなかったコメントは再び問い合わせるが、LLMの応答はキャッシュされている)
+    previous = None
+    if incremental_update(config, "extraction"):
+        previous = read_artifact(config, "args")
+        # 入力から削除されたコメントの意見は取り除く
+        previous = previous[previous["comment-id"].isin(comment_ids)]
+        extracted_before = pd.Series(comment_ids).isin(previous["comment-id"]).values
+        comment_ids = comment_ids[~extracted_before]
+        print(f"Incremental extraction: {len(comment_ids)} new comments")
+    elif retry_ids(config, "extraction"):
+        # 前回の実行で抽出できなかったコメントだけを問い合わせ直し、他は前回の結果を使う
+        previous = read_artifact(config, "args")
+        retry = pd.Series(comment_ids).isin(retry_ids(config, "extraction")).values
+        comment_ids = comment_ids[retry]
+        print(f"Retrying the extraction of {len(comment_ids)} comments")
     update_progress(config, total=len(comment_ids))
 
-    existing_arguments = set()
-
-    for i in tqdm(range(0, len(comment_ids), workers)):
-        batch = comment_ids[i : i + workers]
-        batch_inputs = [comments.loc[id]["comment-body"] for id in batch]
-        batch_results = extract_batch(batch_inputs, prompt, model, workers)
-        for comment_id, extracted_args in zip(batch, batch_results):
-            for j, arg in enumerate(extracted_args):
-                if arg not in existing_arguments:
-                    properties = {
-                        prop: comments.loc[comment_id][prop]
-                        for prop in property_columns
-                    }
-                    new_row = {
-                        "arg-id": f"A{comment_id}_{j}",
-                        "comment-id": int(comment_id),
-                        "argument": arg,
-                        **properties,
-                    }
-                    results = pd.concat(
-                        [results, pd.DataFrame([new_row])], ignore_index=True
-                    )
-                    existing_arguments.add(arg)
-        update_progress(config, incr=len(batch))
-    if results.shape == (0, 0):
+    # 抽出結果はコメントごとにチェックポイントへ追記し、中断後の再実行ではそこから再開する
+    checkpoint_path = f"outputs/{dataset}/extraction_checkpoint.jsonl"
+    header = _checkpoint_header(config)
+    extracted = _load_checkpoint(checkpoint_path, header)
+    remaining = [id for id in comment_ids if int(id) not in extracted]
+    if len(remaining) < len(comment_ids):
+        print(f"Resuming extraction: {len(comment_ids) - len(remaining)} comments done")
+        update_progress(config, incr=len(comment_ids) - len(remaining))
+
+    with open(checkpoint_path, "a") as checkpoint:
+        if checkpoint.tell() == 0:
+            checkpoint.write(json.dumps(header) + "\n")
+
+        def on_result(comment_id, extracted_args):
+            extracted[int(comment_id)] = extracted_args
+            record = {"comment-id": int(comment_id), "arguments": extracted_args}
+            checkpoint.write(json.dumps(record, ensure_ascii=False) + "\n")
+            checkpoint.flush()
+            update_progress(config, incr=1)
+
+        failed, retried = extract_queue(
+            remaining, comments["comment-body"], prompt, model, workers, on_result
+        )
+    # 読めない応答しか返らなかったコメントは除いて args.csv を書き、後続のステップを止めない。
+    # 次の実行ではそれらのコメントだけを抽出し直す (decide_what_to_run が再実行を計画する)
+    failed_ids = [int(id) for id in failed]
+    if failed_ids:
+        print(f"Could not extract {len(failed_ids)} comments: {failed_ids}")
+    update_step_stats(
+        config,
+        {
+            "retried_comments": retried,
+            "dropped_comments": len(failed_ids),
+            "failed_ids": failed_ids,
+        },
+    )
+
+    results = _build_arguments(comment_ids, extracted, comments, property_columns)
+    if previous is not None:
+        results = results[~results["argument"].isin(previous["argument"])]
+        update_step_stats(
+            config,
+            {
+                "incremental": config.get("incremental", False),
+                "new_arguments": len(results),
+            },
+        )
+    elif results.empty:
         raise RuntimeError("result is empty, maybe bad prompt")
 
     classification_categories = config["extraction"]["categories"]
-    if classification_categories:
-        results = classify_args(results, config, workers)
-    results.to_csv(path, index=False)
+    if classification_categories and not results.empty:
+        results = classify_args(results.reset_index(drop=True), config)
+    if previous is not None:
+        results = pd.concat([previous, results], ignore_index=True)
+    write_artifact(config, "args", results)
+    os.remove(checkpoint_path)
 
 
-logging.basicConfig(level=logging.ERROR)
+def _checkpoint_header(config):
+    # 入力ファイルや limit が変わったら、以前のチェックポイントの意見は使わない
+    key = cache_key(
+        config["extraction"]["prompt"],
+        config["extraction"]["model"],
+        file_hash(f"inputs/{config['input']}.csv"),
+        config["extraction"]["limit"],
+    )
+    return {"checkpoint": key}
+
 
+def _read_header(line):
+    try:
+        return json.loads(line)
+    except json.decoder.JSONDecodeError:
+        # 1行目の書き込み途中で中断された場合は、別の設定のチェックポイントと同様に捨てる
+        return None
 
-def extract_batch(batch, prompt, model, workers):
-    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
-        futures_with_index = [
-            (i, executor.submit(extract_arguments, input, prompt, model))
-            for i, input in enumerate(batch)
-        ]
 
-        done, not_done = concurrent.futures.wait(
-            [f for _, f in futures_with_index], timeout=30
-        )
-        results = [[] for _ in range(len(batch))]
+def _load_checkpoint(checkpoint_path, header) -> dict[int, list[str]]:
+    if not os.path.exists(checkpoint_path):
+        return {}
+    extracted = {}
+    with open(checkpoint_path) as f:
+        lines = f.read().splitlines()
+    if not lines or _read_header(lines[0]) != header:
+        print("Discarding extraction checkpoint made with another input, prompt or model")
+        os.remove(checkpoint_path)
+        return {}
+    for line in lines[1:]:
+        try:
+            record = json.loads(line)
+        except json.decoder.JSONDecodeError:
+            # 書き込み途中で中断された行は読み飛ばす
+            continue
+        extracted[record["comment-id"]] = record["arguments"]
+    return extracted
+
 
-        for _, future in futures_with_index:
-            if future in not_done and not future.cancelled():
-                future.cancel()
+def _build_arguments(
+    comment_ids, extracted: dict[int, list[str]], comments: pd.DataFrame, property_columns
+) -> pd.DataFrame:
+    ids = [int(id) for id in comment_ids]
+    results = pd.DataFrame(
+        {"comment-id": ids, "argument": [extracted.get(id, []) for id in ids]}
+    ).explode("argument")
+    results = results.dropna(subset=["argument"])
+    # 同じコメントから抽出された意見の通し番号 (重複を取り除く前に振る)
+    index_in_comment = results.groupby(level=0).cumcount()
+    results.insert(
+        0,
+        "arg-id",
+        "A" + results["comment-id"].astype(str) + "_" + index_in_comment.astype(str),
+    )
+    results = results.drop_duplicates(subset="argument").reset_index(drop=True)
+    properties = comments.loc[~comments.index.duplicated(), property_columns]
+    return results.merge(properties, left_on="comment-id", right_index=True, how="left")
 
-        for i, future in futures_with_index:
-            if future in done:
+
+logging.basicConfig(level=logging.ERROR)
+
+
+def extract_queue(
+    comment_ids,
+    bodies,
+    prompt,
+    model,
+    workers,
+    on_result,
+    submit=submit_to_chat_openai,
+):
+    """
+    常に workers 件のリクエストが実行中になるように、完了したものから次のコメントを投入する。
+    エンジンでの再試行を使い切ったタイムアウトや一時的なエラーは、成功するまで投入し直す。
+    意見のリストとして読めない応答 (キャッシュされない) は PARSE_ATTEMPTS 回まで問い合わせ、
+    それでも読めなければ失敗として返す (呼び出し元はそのコメントを除いて続ける)。
+    失敗したコメントと、問い合わせ直したコメントの件数を返す。
+
+    >>> import concurrent.futures
+    >>> def submit(messages, model, validate):
+    ...     future = concurrent.futures.Future()
+    ...     body = messages[1]["content"]
+    ...     future.set_result('["意見"]' if body == "読める" else "説明だけの応答")
+    ...     return future
+    >>> bodies = pd.Series({1: "読める", 2: "読めない"})
+    >>> extracted = {}
+    >>> extract_queue(
+    ...     [1, 2], bodies, "prompt", "model", 2, extracted.__setitem__, submit
+    ... )
+    ([2], 1)
+    >>> extracted
+    {1: ['意見']}
+    """
+    queue = deque(comment_ids)
+    in_flight = {}
+    failed = []
+    retried = set()
+    parse_failures = Counter()
+    with tqdm(total=len(comment_ids)) as progress:
+        while queue or in_flight:
+            while queue and len(in_flight) < workers:
+                comment_id = queue.popleft()
+                input = bodies.loc[comment_id]
+                future = submit(
+                    messages=_messages(input, prompt),
+                    model=model,
+                    # JSONのリストとして読めない応答はキャッシュしない
+                    validate=lambda response: parse_response(response) is not None,
+                )
+                in_flight[future] = (comment_id, input)
+            done, _ = concurrent.futures.wait(
+                in_flight, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                comment_id, input = in_flight.pop(future)
                 try:
-                    result = future.result()
-                    results[i] = result
+                    response = future.result()
+                except RETRYABLE_ERRORS as e:
+                    logging.warning(
+                        f"Could not extract comment {comment_id}, retrying: {e}"
+                    )
+                    retried.add(comment_id)
+                    queue.append(comment_id)
+                    continue
                 except Exception as e:
-                    logging.error(f"Task {future} failed with error: {e}")
-                    results[i] = []
-        return results
+                    logging.error(f"Could not extract comment {comment_id}: {e}")
+                    failed.append(comment_id)
+                    progress.update(1)
+                    continue
+                try:
+                    extracted_args = list(_parse_arguments(response))
+                except Exception as e:
+                    parse_failures[comment_id] += 1
+                    if parse_failures[comment_id] < PARSE_ATTEMPTS:
+                        logging.warning(
+                            f"Could not parse arguments of {comment_id}, retrying: {e}"
+                        )
+                        retried.add(comment_id)
+                        queue.append(comment_id)
+                        continue
+                    logging.error(
+                        f"Could not parse arguments of {comment_id}: {e}\n"
+                        f"Input was: {input}\nResponse was: {response}"
+                    )
+                    failed.append(comment_id)
+                    progress.update(1)
+                    continue
+                progress.update(1)
+                on_result(comment_id, extracted_args)
+    return failed, len(retried)
 
 
-def extract_by_llm(input, prompt, model):
-    messages = [
+def _messages(input, prompt):
+    return [
         {"role": "system", "content": prompt},
         {"role": "user", "content": input},
     ]
-    response = request_to_chat_openai(messages=messages, model=model)
-    return response
 
 
-def extract_arguments(input, prompt, model, retries=1):
-    messages = [
-        {"role": "system", "content": prompt},
-        {"role": "user", "content": input},
-    ]
-    try:
-        response = request_to_chat_openai(messages=messages, model=model, is_json=False)
-        items = parse_response(response)
-        items = filter(None, items)  # omit empty strings
-        return items
-    except json.decoder.JSONDecodeError as e:
-        print("JSON error:", e)
-        print("Input was:", input)
-        print("Response was:", response)
-        print("Silently giving up on trying to generate valid list.")
-        return []
+def _parse_arguments(response):
+    # 読めない応答は例外として呼び出し元に返し、空の結果としてチェックポイントに残さない
+    items = parse_response(response)
+    return filter(None, items)  # omit empty strings
@@ -1,11 +1,13 @@
 """Create labels for the clusters."""
 
-import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
+from services.artifacts import read_artifact, write_artifact
+from services.cluster_index import ClusterIndex, changed_clusters, cluster_random
 from services.llm import request_to_chat_openai
-from utils import update_progress
+from services.step_context import step_executor
+from utils import incremental_update, update_progress, update_step_stats
 
 # TODO: プロンプト設定の外部化
 BASE_SELECTION_PROMPT = """クラスタにつけられたラベル名と、紐づくデータ点のテキストを与えるので、
@@ -39,94 +41,141 @@ def select_relevant_ids_by_llm(prompt, model="gpt-4o"):
 
 
 def select_representative_args(
-    cluster_args, label, cid, model="gpt-4o", sampling_num=50
+    index, texts, label, cid, model="gpt-4o", sampling_num=50
 ):
-    arg_rows = cluster_args[cluster_args["cluster-id"] == cid].sort_values(
-        by="probability", ascending=False
-    )
     # hdbscanのクラスタにおける所属確率(probability)が高い順に取得し、代表コメントの候補とする
-    top_rows = arg_rows.head(sampling_num)
+    top_positions = index.top_k(cid, sampling_num, by="probability")
+    arg_ids = index.table["arg-id"].values
     args_text = "\n".join(
-        [
-            f"{row['arg-id']}: {row['argument']}"
-            for _, (_, row) in enumerate(top_rows.iterrows())
-        ]
+        [f"{arg_ids[position]}: {texts[position]}" for position in top_positions]
     )
     prompt = BASE_SELECTION_PROMPT.format(label=label, args_text=args_text)
     selected_ids = select_relevant_ids_by_llm(prompt, model)
     return selected_ids
 
 
-def update_cluster_probability(config, arguments, clusters, labels):
-    cluster_args = arguments.merge(clusters, on="arg-id", how="left")
-    for _, row in labels.iterrows():
-        cid = row["cluster-id"]
-        label = row["label"]
-        selected_ids = select_representative_args(cluster_args, label, cid)
-        for id in selected_ids:
-            mask = cluster_args["arg-id"] == id
-            clusters.loc[mask, "probability"] += 100
-    clusters.to_csv(f"outputs/{config['output_dir']}/clusters.csv", index=False)
+def select_representatives(index, texts, labels, workers=1) -> list[str]:
+    """
+    Representative arguments of each labelled cluster, as comma-separated
+    arg-ids. They are stored with the labels instead of being added to the
+    probabilities in clusters.csv, which stays the output of clustering.
+    """
 
+    def select(row):
+        return select_representative_args(
+            index, texts, row["label"], row["cluster-id"]
+        )
 
-def labelling(config):
-    dataset = config["output_dir"]
-    path = f"outputs/{dataset}/labels.csv"
+    with step_executor(workers) as executor:
+        selections = list(executor.map(select, [row for _, row in labels.iterrows()]))
+    return [",".join(selected_ids) for selected_ids in selections]
+
+
+def sample_clusters(index, texts, cluster_ids, sample_size, seed):
+    """
+    Arguments inside and outside of each cluster to put in its labelling
+    prompt, drawn with a generator seeded per cluster.
+
+    >>> import numpy as np
+    >>> index = ClusterIndex(
+    ...     pd.DataFrame(
+    ...         {
+    ...             "arg-id": [f"A{i}_0" for i in range(100)],
+    ...             "cluster-id": [i % 3 for i in range(100)],
+    ...         }
+    ...     )
+    ... )
+    >>> texts = np.array([f"意見 {i}" for i in range(100)])
+    >>> def prompts():
+    ...     samples = sample_clusters(index, texts, index.cluster_ids, 5, seed=42)
+    ...     return [
+    ...         generate_label_input("質問", inside, outside)
+    ...         for inside, outside in samples
+    ...     ]
+    >>> prompts() == prompts()
+    True
+    """
+    samples = []
+    for cluster_id in cluster_ids:
+        random = cluster_random(seed, cluster_id)
+        args_sample = texts[index.sample(cluster_id, sample_size, random)]
+        args_sample_outside = texts[
+            index.sample_outside(cluster_id, sample_size, random)
+        ]
+        samples.append((args_sample, args_sample_outside))
+    return samples
 
-    arguments = pd.read_csv(f"outputs/{dataset}/args.csv")
-    clusters = pd.read_csv(f"outputs/{dataset}/clusters.csv")
 
-    results = pd.DataFrame()
+def labelling(config):
+    arguments = read_artifact(config, "args", columns=["arg-id", "argument"])
+    clusters = read_artifact(config, "clusters")
 
     sample_size = config["labelling"]["sample_size"]
     prompt = config["labelling"]["prompt"]
     model = config["labelling"]["model"]
+    workers = config["labelling"]["workers"]
+    seed = config["labelling"]["seed"]
 
     question = config["question"]
-    cluster_ids = clusters["cluster-id"].unique()
-
-    update_progress(config, total=len(cluster_ids))
 
-    for _, cluster_id in tqdm(enumerate(cluster_ids), total=len(cluster_ids)):
-        args_ids = clusters[clusters["cluster-id"] == cluster_id]["arg-id"].values
-        args_ids = np.random.choice(
-            args_ids, size=min(len(args_ids), sample_size), replace=False
-        )
-        args_sample = arguments[arguments["arg-id"].isin(args_ids)]["argument"].values
-
-        args_ids_outside = clusters[clusters["cluster-id"] != cluster_id][
-            "arg-id"
-        ].values
-        args_ids_outside = np.random.choice(
-            args_ids_outside,
-            size=min(len(args_ids_outside), sample_size),
-            replace=False,
-        )
-        args_sample_outside = arguments[arguments["arg-id"].isin(args_ids_outside)][
-            "argument"
-        ].values
+    # クラスタごとの行を一度だけ索引しておき、サンプリングはその中から行う
+    index = ClusterIndex(clusters)
+    texts = index.align(arguments.set_index("arg-id")["argument"])
+    cluster_ids = index.cluster_ids
+    sizes = index.sizes()
+
+    # --incremental: 意見が一定以上増減したクラスタだけラベルを付け直す
+    previous = None
+    if incremental_update(config, "labelling", upstream="clustering"):
+        previous = read_artifact(config, "labels")
+        if "size" in previous.columns:
+            threshold = config["labelling"]["relabel_threshold"]
+            cluster_ids = changed_clusters(index, previous, threshold)
+            print(f"Relabelling {len(cluster_ids)} of {len(sizes)} clusters")
+            update_step_stats(config, {"relabelled_clusters": len(cluster_ids)})
+        else:
+            previous = None
 
-        label = generate_label(
-            question, args_sample, args_sample_outside, prompt, model
-        )
-        results = pd.concat(
-            [results, pd.DataFrame([{"cluster-id": cluster_id, "label": label}])],
-            ignore_index=True,
-        )
-        update_progress(config, incr=1)
+    update_progress(config, total=len(cluster_ids))
+    samples = sample_clusters(index, texts, cluster_ids, sample_size, seed)
+
+    def label_cluster(sample):
+        args_sample, args_sample_outside = sample
+        return generate_label(question, args_sample, args_sample_outside, prompt, model)
+
+    labels = []
+    with step_executor(workers) as executor:
+        for label in tqdm(executor.map(label_cluster, samples), total=len(samples)):
+            labels.append(label)
+            update_progress(config, incr=1)
+    results = pd.DataFrame(
+        {"cluster-id": cluster_ids, "label": labels, "size": sizes[cluster_ids].values}
+    )
+    results["representatives"] = select_representatives(index, texts, results, workers)
+    if previous is not None:
+        # 付け直さなかったクラスタは、ラベルを付けた時点の大きさのまま残す
+        kept = previous[
+            previous["cluster-id"].isin(sizes.index)
+            & ~previous["cluster-id"].isin(cluster_ids)
+        ]
+        results = pd.concat([kept, results]).set_index("cluster-id")
+        results = results.loc[sizes.index].reset_index()
 
-    results.to_csv(path, index=False)
-    update_cluster_probability(config, arguments, clusters, results)
+    write_artifact(config, "labels", results)
 
 
-def generate_label(question, args_sample, args_sample_outside, prompt, model):
+def generate_label_input(question, args_sample, args_sample_outside):
     outside = "\n * " + "\n * ".join(args_sample_outside)
     inside = "\n * " + "\n * ".join(args_sample)
-    input = (
+    return (
         f"質問:\n{question}\n\n"
         + f"クラスタ外部の意見:\n{outside}\n"
         + f"クラスタ内部の意見:\n{inside}"
     )
+
+
+def generate_label(question, args_sample, args_sample_outside, prompt, model):
+    input = generate_label_input(question, args_sample, args_sample_outside)
     messages = [{"role": "user", "content": prompt}, {"role": "user", "content": input}]
     response = request_to_chat_openai(messages=messages, model=model)
     return response
@@ -1,7 +1,6 @@
 """Create summaries for the clusters."""
 
-import pandas as pd
-
+from services.artifacts import read_artifact
 from services.llm import request_to_chat_openai
 
 
@@ -9,8 +8,8 @@ def overview(config):
     dataset = config["output_dir"]
     path = f"outputs/{dataset}/overview.txt"
 
-    takeaways = pd.read_csv(f"outputs/{dataset}/takeaways.csv")
-    labels = pd.read_csv(f"outputs/{dataset}/labels.csv")
+    takeaways = read_artifact(config, "takeaways")
+    labels = read_artifact(config, "labels")
 
     prompt = config["overview"]["prompt"]
     model = config["overview"]["model"]
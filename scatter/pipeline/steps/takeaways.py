@@ -1,45 +1,75 @@
 """Create summaries for the clusters."""
 
-import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
+from services.artifacts import read_artifact, write_artifact
+from services.cluster_index import ClusterIndex, changed_clusters, cluster_random
 from services.llm import request_to_chat_openai
-from utils import update_progress
+from services.step_context import step_executor
+from utils import incremental_update, update_progress, update_step_stats
 
 
 def takeaways(config):
-    dataset = config["output_dir"]
-    path = f"outputs/{dataset}/takeaways.csv"
-
-    arguments = pd.read_csv(f"outputs/{dataset}/args.csv")
-    clusters = pd.read_csv(f"outputs/{dataset}/clusters.csv")
-
-    results = pd.DataFrame()
+    arguments = read_artifact(config, "args", columns=["arg-id", "argument"])
+    clusters = read_artifact(config, "clusters", columns=["arg-id", "cluster-id"])
 
     sample_size = config["takeaways"]["sample_size"]
     prompt = config["takeaways"]["prompt"]
     model = config["takeaways"]["model"]
+    workers = config["takeaways"]["workers"]
+    seed = config["takeaways"]["seed"]
 
     model = config.get("model_takeaways", config.get("model", "gpt3.5-turbo"))
-    cluster_ids = clusters["cluster-id"].unique()
+
+    index = ClusterIndex(clusters)
+    texts = index.align(arguments.set_index("arg-id")["argument"])
+    cluster_ids = index.cluster_ids
+    sizes = index.sizes()
+
+    # --incremental: 意見が一定以上増減したクラスタだけ要約し直す
+    previous = None
+    if incremental_update(config, "takeaways", upstream="clustering"):
+        previous = read_artifact(config, "takeaways")
+        if "size" in previous.columns:
+            threshold = config["takeaways"]["relabel_threshold"]
+            cluster_ids = changed_clusters(index, previous, threshold)
+            print(f"Summarizing {len(cluster_ids)} of {len(sizes)} clusters again")
+            update_step_stats(config, {"summarized_clusters": len(cluster_ids)})
+        else:
+            previous = None
 
     update_progress(config, total=len(cluster_ids))
+    samples = [
+        texts[index.sample(cluster_id, sample_size, cluster_random(seed, cluster_id))]
+        for cluster_id in cluster_ids
+    ]
+
+    summaries = []
+    with step_executor(workers) as executor:
+        for label in tqdm(
+            executor.map(lambda sample: generate_takeaways(sample, prompt, model), samples),
+            total=len(samples),
+        ):
+            summaries.append(label)
+            update_progress(config, incr=1)
+    results = pd.DataFrame(
+        {
+            "cluster-id": cluster_ids,
+            "takeaways": summaries,
+            "size": sizes[cluster_ids].values,
+        }
+    )
+    if previous is not None:
+        # 要約し直さなかったクラスタは、要約した時点の大きさのまま残す
+        kept = previous[
+            previous["cluster-id"].isin(sizes.index)
+            & ~previous["cluster-id"].isin(cluster_ids)
+        ]
+        results = pd.concat([kept, results]).set_index("cluster-id")
+        results = results.loc[sizes.index].reset_index()
 
-    for _, cluster_id in tqdm(enumerate(cluster_ids), total=len(cluster_ids)):
-        args_ids = clusters[clusters["cluster-id"] == cluster_id]["arg-id"].values
-        args_ids = np.random.choice(
-            args_ids, size=min(len(args_ids), sample_size), replace=False
-        )
-        args_sample = arguments[arguments["arg-id"].isin(args_ids)]["argument"].values
-        label = generate_takeaways(args_sample, prompt, model)
-        results = pd.concat(
-            [results, pd.DataFrame([{"cluster-id": cluster_id, "takeaways": label}])],
-            ignore_index=True,
-        )
-        update_progress(config, incr=1)
-
-    results.to_csv(path, index=False)
+    write_artifact(config, "takeaways", results)
 
 
 def generate_takeaways(args_sample, prompt, model):
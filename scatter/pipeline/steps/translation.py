@@ -1,14 +1,20 @@
 import json
 
-import pandas as pd
-from langchain.chat_models import ChatOpenAI
 from tqdm import tqdm
 
-from utils import messages
+from services.artifacts import read_artifact
+from services.disk_cache import DiskCache, cache_key
+from services.llm import count_tokens, request_to_chat_openai, submit_to_chat_openai
+from utils import chat_messages
+
+# 翻訳メモリ: (原文, 言語, モデル, プロンプト) ごとの訳文を実行やデータセットをまたいで再利用する
+TRANSLATION_MEMORY = DiskCache("translations")
+# 訳文のトークン数は原文の2倍程度までと見積もる (日本語と英語の間など)
+OUTPUT_TOKEN_RATIO = 2
 
 JAPANESE_UI_MAP = {
     "Argument": "議論",
-    # "Original comment": "元のコメント",
+    "Original comment": "元のコメント",
     "Representative arguments": "代表的な議論",
     "Open full-screen map": "全画面地図を開く",
     "Back to report": "レポートに戻る",
@@ -62,9 +68,9 @@ def translation(config):
             json.dump(results, file, indent=2)
         return
 
-    arguments = pd.read_csv(f"outputs/{dataset}/args.csv")
-    labels = pd.read_csv(f"outputs/{dataset}/labels.csv")
-    takeaways = pd.read_csv(f"outputs/{dataset}/takeaways.csv")
+    arguments = read_artifact(config, "args", columns=["argument"])
+    labels = read_artifact(config, "labels", columns=["label"])
+    takeaways = read_artifact(config, "takeaways", columns=["takeaways"])
     with open(f"outputs/{dataset}/overview.txt") as f:
         overview = f.read()
 
@@ -131,74 +137,159 @@ def translation(config):
 
     config["translation_prompt"] = prompt
 
-    translations = [
-        translate_lang(arg_list, 10, prompt, lang, model) for lang in languages
-    ]
-
-    # handling long takeaways differently, WITHOUT batching too much
+    # 長い要約・概要もトークン数の予算に従ってまとめる
     long_arg_list = takeaways["takeaways"].to_list()
     long_arg_list.append(overview)
     if "intro" in config:
         long_arg_list.append(config["intro"])
 
-    long_translations = [
-        translate_lang(long_arg_list, 1, prompt, lang, model) for lang in languages
-    ]
-
-    for i, id in enumerate(arg_list):
-        print("i, id", i, id)
-        results[str(id)] = list([t[i] for t in translations])
-    for i, id in enumerate(long_arg_list):
-        results[str(id)] = list([t[i] for t in long_translations])
+    # 同じ文字列 (UIの文言や重複した意見) は一度だけ翻訳する
+    texts = list(dict.fromkeys(arg_list + long_arg_list))
+    translations = translate_texts(
+        texts,
+        prompt,
+        languages,
+        model,
+        batch_tokens=config["translation"]["batch_tokens"],
+        batch_output_tokens=config["translation"]["batch_output_tokens"],
+    )
+    for text in texts:
+        results[str(text)] = [translations[lang][text] for lang in languages]
 
     with open(path, "w") as file:
         json.dump(results, file, indent=2)
 
 
-def translate_lang(arg_list, batch_size, prompt, lang, model):
-    translations = []
-    lang_prompt = prompt.replace("{language}", lang)
-    print(f"Translating to {lang}...")
-    for i in tqdm(range(0, len(arg_list), batch_size)):
-        batch = arg_list[i : i + batch_size]
-        translations.extend(translate_batch(batch, lang_prompt, model))
-    return translations
+def pack_batches(texts, model, batch_tokens, batch_output_tokens) -> list[list]:
+    """
+    Group `texts` into batches whose input fits in `batch_tokens` and whose
+    expected translation fits in `batch_output_tokens`. A text larger than
+    the budget is sent on its own.
+    """
+    batches = []
+    batch = []
+    tokens = 0
+    for text in texts:
+        # キーと引用符・区切りの分を数トークン足す
+        n = count_tokens(text, model) + 8
+        if batch and (
+            tokens + n > batch_tokens
+            or (tokens + n) * OUTPUT_TOKEN_RATIO > batch_output_tokens
+        ):
+            batches.append(batch)
+            batch = []
+            tokens = 0
+        batch.append(text)
+        tokens += n
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def translate_texts(
+    texts, prompt, languages, model, batch_tokens=2000, batch_output_tokens=4000
+) -> dict:
+    """
+    Translate `texts` to every language, as {language: {text: translation}}.
+    Texts already in the translation memory are not sent again, and the
+    batches of all languages are submitted at once so that the LLM engine
+    runs them concurrently.
+    """
+    keys = {
+        lang: {text: cache_key(text, lang, model, prompt) for text in texts}
+        for lang in languages
+    }
+    found = TRANSLATION_MEMORY.get_many(
+        [key for lang in languages for key in keys[lang].values()]
+    )
+    # 各テキストには texts の中の位置をIDとして付け、応答との対応づけに使う
+    ids = {text: str(i) for i, text in enumerate(texts)}
+    pending = []
+    for lang in languages:
+        lang_prompt = prompt.replace("{language}", lang)
+        missing = [text for text in texts if keys[lang][text] not in found]
+        for batch in pack_batches(missing, model, batch_tokens, batch_output_tokens):
+            batch = {ids[text]: text for text in batch}
+            future = submit_to_chat_openai(
+                messages=_messages(lang_prompt, batch),
+                model=model,
+                is_json=True,
+                validate=_validator(batch),
+            )
+            pending.append((lang, lang_prompt, batch, future))
+    print(
+        f"Translating {sum(len(batch) for _, _, batch, _ in pending)} texts "
+        f"in {len(pending)} requests to {len(languages)} languages "
+        f"({len(found)} found in the translation memory)"
+    )
+    for lang, lang_prompt, batch, future in tqdm(pending):
+        translated = translate_batch(batch, lang_prompt, model, response=future.result())
+        memory = {keys[lang][text]: translated[id] for id, text in batch.items()}
+        TRANSLATION_MEMORY.set_many(memory)
+        found.update(memory)
+    return {
+        lang: {text: found[keys[lang][text]] for text in texts} for lang in languages
+    }
+
+
+def _messages(lang_prompt, batch: dict):
+    return chat_messages(lang_prompt, json.dumps(batch, ensure_ascii=False))
 
 
-def translate_batch(batch, lang_prompt, model, retries=3):
-    llm = ChatOpenAI(model_name=model, temperature=0.0)
-    input = json.dumps(list(batch))
-    response = llm(messages=messages(lang_prompt, input)).content.strip()
+def _validator(batch: dict):
+    # すべての id の翻訳を含む応答だけをキャッシュする
+    return lambda response: len(_parse_translations(response, batch, verbose=False)) == len(batch)
+
+
+def _parse_translations(response, batch: dict, verbose=True) -> dict:
+    response = response.strip()
     if "```" in response:
         response = response.split("```")[1]
     if response.startswith("json"):
         response = response[4:]
     try:
-        parsed = [a.strip() for a in json.loads(response)]
-        if len(parsed) != len(batch):
-            print("Warning: batch size mismatch!")
-            print("Batch len:", len(batch))
-            print("Response len:", len(parsed))
-            for i, item in enumerate(batch):
-                print(f"Batch item {i}:", item)
-                if i < len(parsed):
-                    print("Response:", parsed[i])
-            if len(batch) > 1:
-                print("Retrying with smaller batches...")
-                mid = len(batch) // 2
-                return translate_batch(
-                    batch[:mid], lang_prompt, model, retries - 1
-                ) + translate_batch(batch[mid:], lang_prompt, model, retries - 1)
-            else:
-                print("Retrying batch...")
-                return translate_batch(batch, lang_prompt, model, retries - 1)
-        else:
-            return parsed
+        parsed = json.loads(response)
     except json.decoder.JSONDecodeError as e:
-        print("JSON error:", e)
-        print("Response was:", response)
-        if retries > 0:
-            print("Retrying batch...")
-            return translate_batch(batch, lang_prompt, model, retries - 1)
-        else:
-            raise e
+        if verbose:
+            print("JSON error:", e)
+            print("Response was:", response)
+        return {}
+    if not isinstance(parsed, dict):
+        return {}
+    return {
+        id: parsed[id].strip()
+        for id in batch
+        if isinstance(parsed.get(id), str) and parsed[id].strip()
+    }
+
+
+def translate_batch(batch: dict, lang_prompt, model, retries=3, response=None) -> dict:
+    """
+    Translate a batch of {id: text} and return {id: translation}.
+    Ids missing from the response are requested again, without the texts
+    that were already translated.
+    """
+    if response is None:
+        response = request_to_chat_openai(
+            messages=_messages(lang_prompt, batch),
+            model=model,
+            is_json=True,
+            validate=_validator(batch),
+        )
+    translated = _parse_translations(response, batch)
+    missing = {id: text for id, text in batch.items() if id not in translated}
+    if not missing:
+        return translated
+    if retries == 0:
+        raise RuntimeError(f"Could not translate {len(missing)} texts: {missing}")
+    print(f"Warning: {len(missing)} of {len(batch)} translations missing, retrying them")
+    if len(translated) == 0 and len(missing) > 1:
+        # 応答がまったく使えなかった場合、同じ依頼を繰り返さずに半分に分ける
+        items = list(missing.items())
+        mid = len(items) // 2
+        parts = [dict(items[:mid]), dict(items[mid:])]
+    else:
+        parts = [missing]
+    for part in parts:
+        translated.update(translate_batch(part, lang_prompt, model, retries - 1))
+    return translated
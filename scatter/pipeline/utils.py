@@ -1,10 +1,19 @@
+import concurrent.futures
+import hashlib
 import json
 import os
+import threading
+import time
 import traceback
 from datetime import datetime, timedelta
 
 from langchain.schema import AIMessage, HumanMessage, SystemMessage
 
+from services.artifacts import FORMATS, atomic_write, output_path, read_input
+from services.llm import evict_llm_cache
+from services.metrics import METRICS, append_jsonl, prometheus_text
+from services.step_context import current_step
+
 with open("./specs.json") as f:
     specs = json.load(f)
 
@@ -19,7 +28,10 @@ def typed_message(t, m):
     raise Exception("Unknown message type in prompt: " + t)
 
 
-def messages(prompt, input):
+CHAT_ROLES = {"system": "system", "human": "user", "ai": "assistant"}
+
+
+def _parse_prompt(prompt, input):
     lines = prompt.strip().splitlines()
     results = []
     t = None
@@ -34,7 +46,20 @@ def messages(prompt, input):
             m += line + "\n"
     results.append((t, m))
     results.append(("human", input))
-    return [typed_message(t, m) for (t, m) in results]
+    return results
+
+
+def messages(prompt, input):
+    return [typed_message(t, m) for (t, m) in _parse_prompt(prompt, input)]
+
+
+def chat_messages(prompt, input):
+    results = []
+    for t, m in _parse_prompt(prompt, input):
+        if t not in CHAT_ROLES:
+            raise Exception(f"Unknown message type in prompt: {t}")
+        results.append({"role": CHAT_ROLES[t], "content": m})
+    return results
 
 
 def validate_config(config):
@@ -42,11 +67,16 @@ def validate_config(config):
         raise Exception("Missing required field 'input' in config")
     if not "question" in config:
         raise Exception("Missing required field 'question' in config")
-    valid_fields = ["input", "question", "model", "name", "intro"]
+    valid_fields = ["input", "question", "model", "name", "intro", "artifact_format"]
     step_names = [x["step"] for x in specs]
     for key in config:
         if key not in valid_fields and key not in step_names:
             raise Exception(f"Unknown field '{key}' in config")
+    if config.get("artifact_format", "csv") not in FORMATS:
+        raise Exception(
+            f"Unknown artifact_format '{config['artifact_format']}' in config, "
+            f"use one of {FORMATS}"
+        )
     for step_spec in specs:
         valid_options = list(step_spec.get("options", {}).keys())
         if step_spec.get("use_llm"):
@@ -58,41 +88,114 @@ def validate_config(config):
                 )
 
 
-def decide_what_to_run(config, previous):
+# 実行のしかたにだけ影響し、出力を変えないオプション (変わっても再実行しない)
+EXECUTION_OPTIONS = [
+    "workers",
+    "batch_tokens",
+    "batch_output_tokens",
+    "category_batch_size",
+    "category_batch_tokens",
+    "local_batch_size",
+    "processes",
+    # --incremental のときに、更新するか作り直すかを決めるだけの閾値
+    "refit_threshold",
+    "relabel_threshold",
+    "source_code",
+]
+
+
+def file_hash(path) -> str | None:
+    if not os.path.isfile(path):
+        return None
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _previous_jobs(config) -> list:
     # find last previously tracked jobs (digging in case previous run failed)
-    previous_jobs = []
     _previous = config.get("previous", None)
     while _previous and _previous.get("previous", None) != None:
         _previous = _previous["previous"]
-    if _previous:
-        previous_jobs = _previous.get("completed_jobs", []) + _previous.get(
-            "previously_completed_jobs", []
-        )
+    if not _previous:
+        return []
+    return _previous.get("completed_jobs", []) + _previous.get(
+        "previously_completed_jobs", []
+    )
+
 
-    # utility function to check if params changed
-
-    def different_params(step):
-        keys = step["dependencies"]["params"]
-        if step.get("use_llm", False):
-            # automagically track prompt and model for llm jobs
-            keys += ["prompt", "model"]
-        match = [x for x in previous_jobs if x["step"] == step["step"]]
-        prev = match[0]["params"]
-        next = config[step["step"]]
-        diff = [key for key in keys if prev.get(key, None) != next.get(key, None)]
+def _last_job(config, step):
+    """Latest completed job of `step`, in this run or in the previous ones."""
+    for job in reversed(config.get("completed_jobs", [])):
+        if job["step"] == step:
+            return job
+    match = [x for x in _previous_jobs(config) if x["step"] == step]
+    return match[0] if match else None
+
+
+def _all_dependencies(stepname) -> list[str]:
+    spec = [x for x in specs if x["step"] == stepname][0]
+    deps = []
+    for dep in spec["dependencies"]["steps"]:
+        for d in _all_dependencies(dep) + [dep]:
+            if d not in deps:
+                deps.append(d)
+    return deps
+
+
+def input_hashes(config, step) -> dict:
+    """
+    Hashes of what `step` reads: the output hashes recorded by the jobs of
+    the steps it depends on (directly or not), and the input CSV file.
+    """
+    hashes = {}
+    for dep in _all_dependencies(step["step"]):
+        job = _last_job(config, dep)
+        hashes[dep] = job.get("output_hash") if job else None
+    if step["dependencies"].get("input", False):
+        hashes["input"] = file_hash(f"inputs/{config['input']}.csv")
+    return hashes
+
+
+def different_params(config, step, prev_job, verbose=True) -> list[str]:
+    # EXECUTION_OPTIONS 以外のすべてのオプション (プロンプト・モデルを含む) の変更が再実行の対象になる
+    prev = prev_job["params"]
+    next = config[step["step"]]
+    defaults = step.get("options", {})
+    keys = [k for k in {**prev, **next} if k not in EXECUTION_OPTIONS]
+    # 以前の実行時にはなかったオプションは、デフォルト値であれば変更とみなさない
+    diff = [
+        key
+        for key in keys
+        if prev.get(key, defaults.get(key)) != next.get(key, defaults.get(key))
+    ]
+    if verbose:
         for key in diff:
             print(
-                f"(!) {step} step parameter '{key}' changed from '{prev.get(key)}' to '{next.get(key)}'"
+                f"(!) {step['step']} step parameter '{key}' changed from '{prev.get(key)}' to '{next.get(key)}'"
             )
-        return diff
+    return diff
 
+
+def different_inputs(config, step, prev_job) -> list[str] | None:
+    """Inputs that changed since `prev_job` ran, or None if it did not record them."""
+    if "inputs" not in prev_job:
+        return None
+    current = input_hashes(config, step)
+    return [k for k in current if prev_job["inputs"].get(k) != current[k]]
+
+
+def decide_what_to_run(config, previous):
     # figure out which steps need to run and why
     plan = []
     for step in specs:
         stepname = step["step"]
         run = True
         reason = None
-        found_prev = len([x for x in previous_jobs if x["step"] == step["step"]]) > 0
+        prev_job = _last_job(config, stepname)
+        entry = {}
         if config.get("force", False):
             reason = "forced with -f"
         elif config.get("only", None) != None and config["only"] != stepname:
@@ -100,28 +203,35 @@ def decide_what_to_run(config, previous):
             reason = "forced another step with -o"
         elif config.get("only") == stepname:
             reason = "forced this step with -o"
-        elif not found_prev:
+        elif prev_job is None:
             reason = "not trace of previous run"
-        elif not os.path.exists(f"outputs/{config['output_dir']}/{step['filename']}"):
+        elif not os.path.exists(output_path(config, step["filename"])):
             reason = "previous data not found"
         else:
             deps = step["dependencies"]["steps"]
             changing_deps = [
                 x["step"] for x in plan if (x["step"] in deps and x["run"] == True)
             ]
-            if len(changing_deps) > 0:
+            diff_params = different_params(config, step, prev_job)
+            diff_inputs = different_inputs(config, step, prev_job)
+            if len(diff_params) > 0:
+                reason = "some parameters changed: " + ", ".join(diff_params)
+            elif diff_inputs:
+                reason = "some inputs changed: " + ", ".join(diff_inputs)
+            elif len(changing_deps) > 0:
                 reason = "some dependent steps will re-run: " + (
                     ", ".join(changing_deps)
                 )
+                # 依存するステップの出力が変わらなければ、実行時にスキップする
+                entry["cutoff"] = diff_inputs is not None
+            elif prev_job.get("stats", {}).get("failed_ids"):
+                # 前回の実行で処理できなかったものだけを、ステップが処理し直す (retry_ids)
+                entry["retry"] = prev_job["stats"]["failed_ids"]
+                reason = f"{len(entry['retry'])} items failed in the last run"
             else:
-                diff_params = different_params(step)
-                if len(diff_params) > 0:
-                    print("diff_params", diff_params)
-                    reason = "some parameters changed: " + ", ".join(diff_params)
-                else:
-                    run = False
-                    reason = "nothing changed"
-        plan.append({"step": stepname, "run": run, "reason": reason})
+                run = False
+                reason = "nothing changed"
+        plan.append({"step": stepname, "run": run, "reason": reason, **entry})
     return plan
 
 
@@ -142,6 +252,8 @@ def initialization(sysargv):
             config["only"] = sysargv[i + 1]
         if option == "-skip-interaction":
             config["skip-interaction"] = True
+        if option == "-incremental":
+            config["incremental"] = True
 
     output_dir = config["output_dir"]
 
@@ -154,7 +266,7 @@ def initialization(sysargv):
 
     # crash if job is already running and locked
     if previous and previous["status"] == "running":
-        if datetime.fromisoformat(previous["lock_until"]) > datetime.now():
+        if _lock_until(output_dir, previous) > datetime.now():
             print("Job already running and locked. Try again in 5 minutes.")
             raise Exception("Job already running.")
         else:
@@ -215,29 +327,188 @@ def initialization(sysargv):
             "completed_jobs": [],
         },
     )
+    write_progress(config, force=True)
+    _start_heartbeat(config)
     return config
 
 
+_status_lock = threading.RLock()
+
+# 進捗は progress.json に書き出し、status.json はステップの開始・終了時にだけ書き直す
+PROGRESS_INTERVAL = 1.0  # progress.json を書き直す最短の間隔 (秒)
+HEARTBEAT_INTERVAL = 60  # 進捗の更新がなくてもロックを延長する間隔 (秒)
+LOCK_DURATION = timedelta(minutes=5)
+_progress_written = 0.0
+_heartbeat_stop = threading.Event()
+
+
+def _lock_until(output_dir, previous) -> datetime:
+    lock_until = datetime.fromisoformat(previous["lock_until"])
+    path = f"outputs/{output_dir}/progress.json"
+    if os.path.exists(path):
+        with open(path) as f:
+            progress = json.load(f)
+        lock_until = max(lock_until, datetime.fromisoformat(progress["lock_until"]))
+    return lock_until
+
+
+def write_progress(config, force=False):
+    """
+    Write the status and progress of the running steps to progress.json,
+    at most once every PROGRESS_INTERVAL seconds unless `force` is set.
+    The file is small and also holds the lock of the run.
+    """
+    global _progress_written
+    with _status_lock:
+        now = time.monotonic()
+        if not force and now - _progress_written < PROGRESS_INTERVAL:
+            return
+        _progress_written = now
+        progress = json.dumps(
+            {
+                "status": config.get("status"),
+                "lock_until": (datetime.now() + LOCK_DURATION).isoformat(),
+                "running_jobs": config.get("running_jobs", {}),
+            },
+            indent=2,
+        )
+        _write_text(f"outputs/{config['output_dir']}/progress.json", progress)
+
+
+def _write_text(path, text):
+    def write(tmp_path):
+        with open(tmp_path, "w") as file:
+            file.write(text)
+
+    # 読み込み側が書きかけのファイルを読まないように、置き換えで書き出す
+    atomic_write(path, write)
+
+
+def _start_heartbeat(config):
+    def beat():
+        while not _heartbeat_stop.wait(HEARTBEAT_INTERVAL):
+            write_progress(config, force=True)
+
+    _heartbeat_stop.clear()
+    threading.Thread(target=beat, daemon=True).start()
+
+
 # (!) make sure to always use this function to update status...
 def update_status(config, updates):
     output_dir = config["output_dir"]
-    for key, value in updates.items():
-        if value is None and key in config:
-            del config[key]
-        else:
-            config[key] = value
-    config["lock_until"] = (datetime.now() + timedelta(minutes=5)).isoformat()
-    with open(f"outputs/{output_dir}/status.json", "w") as file:
-        json.dump(config, file, indent=2)
+    # ステップが並行して実行されるので、configの更新と書き出しはまとめて排他する
+    with _status_lock:
+        for key, value in updates.items():
+            if value is None and key in config:
+                del config[key]
+            else:
+                config[key] = value
+        config["lock_until"] = (datetime.now() + LOCK_DURATION).isoformat()
+        with open(f"outputs/{output_dir}/status.json", "w") as file:
+            json.dump(config, file, indent=2)
+
+
+def _running_job(config, step=None) -> dict:
+    return config.get("running_jobs", {}).get(step or current_step.get(), {})
+
+
+def _update_running_job(config, updates, step=None, force=False):
+    # 実行中のステップごとに、開始時刻・進捗・統計を running_jobs に記録する
+    step = step or current_step.get()
+    with _status_lock:
+        running = dict(config.get("running_jobs", {}))
+        running[step] = {**running.get(step, {}), **updates}
+        config["running_jobs"] = running
+        write_progress(config, force=force)
 
 
 def update_progress(config, incr=None, total=None):
     if total is not None:
-        update_status(config, {"current_job_progress": 0, "current_jop_tasks": total})
+        _update_running_job(config, {"progress": 0, "tasks": total})
     elif incr is not None:
-        update_status(
-            config, {"current_job_progress": config["current_job_progress"] + incr}
+        with _status_lock:
+            progress = _running_job(config).get("progress", 0)
+            _update_running_job(config, {"progress": progress + incr})
+
+
+def update_step_stats(config, stats):
+    with _status_lock:
+        current = _running_job(config).get("stats", {})
+        _update_running_job(config, {"stats": {**current, **stats}})
+
+
+def retry_ids(config, step) -> list:
+    """
+    Items that the last run of `step` left out (`failed_ids` in its stats)
+    and that this run only has to process again, keeping the rest of the
+    previous output. Empty when the step is re-run for another reason.
+    """
+    plan = [x for x in config.get("plan", []) if x["step"] == step]
+    return plan[0].get("retry", []) if plan else []
+
+
+def incremental_update(config, step, upstream=None) -> bool:
+    """
+    Whether `step` should update its previous output instead of recomputing it
+    (--incremental): the output exists, the parameters of the step did not
+    change and, when given, the `upstream` step updated its own output
+    incrementally in this run.
+    """
+    if not config.get("incremental", False):
+        return False
+    spec = [x for x in specs if x["step"] == step][0]
+    prev_job = _last_job(config, step)
+    if prev_job is None or not os.path.exists(output_path(config, spec["filename"])):
+        print(f"--incremental: no previous output of {step}, running it in full")
+        return False
+    changed = different_params(config, spec, prev_job, verbose=False)
+    if changed:
+        print(
+            f"--incremental: {step} options {changed} changed since the last run, "
+            "running it in full"
         )
+        return False
+    if upstream is not None:
+        jobs = [x for x in config.get("completed_jobs", []) if x["step"] == upstream]
+        return bool(jobs) and jobs[-1]["stats"].get("incremental", False)
+    return True
+
+
+def _comment_count(config) -> int | None:
+    path = f"inputs/{config['input']}.csv"
+    if not os.path.exists(path):
+        return None
+    comments = len(read_input(config, columns=["comment-id"]))
+    return min(comments, config.get("extraction", {}).get("limit", comments))
+
+
+def step_metrics(config, step) -> dict:
+    """LLM and embedding calls of `step`: counts, tokens, cost and latency."""
+    metrics = METRICS.summary(step)
+    comments = _comment_count(config)
+    if comments:
+        tokens = metrics["prompt_tokens"] + metrics["completion_tokens"]
+        metrics["tokens_per_comment"] = round(tokens / comments, 2)
+    return metrics
+
+
+def export_metrics(config, step):
+    """
+    Append the calls and the metrics of `step` to metrics.jsonl, and rewrite
+    metrics.prom (Prometheus textfile) with the steps completed in this run.
+    """
+    output_dir = config["output_dir"]
+    job = [x for x in config["completed_jobs"] if x["step"] == step][-1]
+    run = {"run": config.get("start_time"), "dataset": output_dir, "step": step}
+    records = [{**run, **call} for call in METRICS.calls(step)]
+    records.append(
+        {**run, "event": "step", "duration": job["duration"], **job["metrics"]}
+    )
+    append_jsonl(f"outputs/{output_dir}/metrics.jsonl", records)
+    _write_text(
+        f"outputs/{output_dir}/metrics.prom",
+        prometheus_text(output_dir, config["completed_jobs"]),
+    )
 
 
 def run_step(step, func, config):
@@ -246,39 +517,177 @@ def run_step(step, func, config):
     if not plan["run"]:
         print(f"Skipping '{step}'")
         return
-    # update status before running...
-    update_status(
-        config,
-        {
-            "current_job": step,
-            "current_job_started": datetime.now().isoformat(),
-        },
+    spec = [x for x in specs if x["step"] == step][0]
+    inputs = input_hashes(config, spec)
+    if plan.get("cutoff"):
+        # early cutoff: 依存するステップを再実行しても出力が変わらなかった場合
+        prev_job = _last_job(config, step)
+        if not different_inputs(config, spec, prev_job):
+            print(f"Skipping '{step}': its inputs did not change")
+            with _status_lock:
+                update_status(
+                    config,
+                    {
+                        "plan": [
+                            {**x, "run": False, "reason": "inputs did not change"}
+                            if x["step"] == step
+                            else x
+                            for x in config["plan"]
+                        ]
+                    },
+                )
+            return
+    token = current_step.set(step)
+    try:
+        # update status before running...
+        with _status_lock:
+            _update_running_job(
+                config, {"started": datetime.now().isoformat()}, force=True
+            )
+            # status.json も実行中のステップを示すように、開始時にも書き出す
+            # (進捗は progress.json にだけ書き、status.json は開始時と終了時に書き直す)
+            update_status(config, {"running_jobs": config["running_jobs"]})
+        print("Running step:", step)
+        # run the step...
+        func(config)
+        metrics = step_metrics(config, step)
+        # update status after running...
+        with _status_lock:
+            job = _running_job(config)
+            running = {
+                k: v for k, v in config["running_jobs"].items() if k != step
+            }
+            update_status(
+                config,
+                {
+                    "running_jobs": running or None,
+                    "completed_jobs": config.get("completed_jobs", [])
+                    + [
+                        {
+                            "step": step,
+                            "completed": datetime.now().isoformat(),
+                            "duration": (
+                                datetime.now() - datetime.fromisoformat(job["started"])
+                            ).total_seconds(),
+                            "params": config[step],
+                            "inputs": inputs,
+                            "output_hash": file_hash(
+                                output_path(config, spec["filename"])
+                            ),
+                            "stats": job.get("stats", {}),
+                            "metrics": metrics,
+                        }
+                    ],
+                },
+            )
+            write_progress(config, force=True)
+            export_metrics(config, step)
+    finally:
+        current_step.reset(token)
+
+
+def critical_path(timings: dict, dependencies: dict) -> list[str]:
+    """
+    Steps that gated the end of the run: starting from the step that
+    finished last, follow the dependency that finished last.
+    """
+    if not timings:
+        return []
+    step = max(timings, key=lambda s: timings[s][1])
+    path = [step]
+    while True:
+        deps = [d for d in dependencies[step] if d in timings]
+        if not deps:
+            break
+        step = max(deps, key=lambda d: timings[d][1])
+        path.append(step)
+    return path[::-1]
+
+
+def run_pipeline(config, functions):
+    """
+    Run the steps of specs.json with `functions` (step name -> function).
+    A step starts as soon as the steps it depends on are done, so
+    independent steps (e.g. labelling and takeaways) run concurrently.
+    """
+    dependencies = {
+        spec["step"]: [d for d in spec["dependencies"]["steps"] if d in functions]
+        for spec in specs
+        if spec["step"] in functions
+    }
+    pending = [spec["step"] for spec in specs if spec["step"] in functions]
+    finished = set()
+    timings = {}
+    started_at = time.monotonic()
+    error = None
+
+    def run(step):
+        started = time.monotonic() - started_at
+        run_step(step, functions[step], config)
+        if [x for x in config["plan"] if x["step"] == step][0]["run"]:
+            timings[step] = (started, time.monotonic() - started_at)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(pending)) as executor:
+        running = {}
+        while running or (pending and error is None):
+            if error is None:
+                ready = [s for s in pending if set(dependencies[s]) <= finished]
+                if len(ready) == 1 and not running:
+                    # 並行して動かせるステップがなければメインスレッドで実行する
+                    # (UMAPが使うOpenMPのスレッドを別スレッドから起動すると、終了時に固まることがある)
+                    step = ready[0]
+                    pending.remove(step)
+                    try:
+                        run(step)
+                        finished.add(step)
+                    except Exception as e:
+                        error = e
+                    continue
+                for step in ready:
+                    pending.remove(step)
+                    running[executor.submit(run, step)] = step
+                if not running:
+                    raise Exception(f"Steps {pending} have unmet dependencies")
+            # 失敗したステップがあれば、実行中のステップの終了を待ってから止める
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                step = running.pop(future)
+                if future.exception() is not None:
+                    error = error or future.exception()
+                else:
+                    finished.add(step)
+    if error is not None:
+        raise error
+
+    path = critical_path(timings, dependencies)
+    print("Run summary:")
+    for step, (started, ended) in sorted(timings.items(), key=lambda x: x[1]):
+        print(f"  {step}: {started:.1f}s - {ended:.1f}s ({ended - started:.1f}s)")
+    print(
+        "Critical path:",
+        " -> ".join(f"{s} ({timings[s][1] - timings[s][0]:.1f}s)" for s in path),
     )
-    print("Running step:", step)
-    # run the step...
-    func(config)
-    # update status after running...
     update_status(
         config,
         {
-            "current_job_progress": None,
-            "current_jop_tasks": None,
-            "completed_jobs": config.get("completed_jobs", [])
-            + [
-                {
-                    "step": step,
-                    "completed": datetime.now().isoformat(),
-                    "duration": (
-                        datetime.fromisoformat(datetime.now().isoformat())
-                        - datetime.fromisoformat(config["current_job_started"])
-                    ).total_seconds(),
-                    "params": config[step],
-                }
-            ],
+            "critical_path": [
+                {"step": s, "duration": round(timings[s][1] - timings[s][0], 3)}
+                for s in path
+            ]
         },
     )
 
 
+def _evict_llm_cache():
+    # 状態を書き込んだ後に行い、失敗してもパイプラインの結果やエラーを上書きしない
+    try:
+        evict_llm_cache()
+    except Exception as e:
+        print(f"Warning: could not evict the LLM cache: {type(e).__name__}: {e}")
+
+
 def termination(config, error=None):
     if "previous" in config:
         # remember all previously completed jobs
@@ -292,6 +701,7 @@ def termination(config, error=None):
         ]
         # now we can drop previous key (we don't want to store infinite history)
         del config["previous"]
+    _heartbeat_stop.set()
     if error is None:
         update_status(
             config,
@@ -300,6 +710,8 @@ def termination(config, error=None):
                 "end_time": datetime.now().isoformat(),
             },
         )
+        write_progress(config, force=True)
+        _evict_llm_cache()
         print("Pipeline completed.")
     else:
         update_status(
@@ -311,4 +723,6 @@ def termination(config, error=None):
                 "error_stack_trace": traceback.format_exc(),
             },
         )
+        write_progress(config, force=True)
+        _evict_llm_cache()
         raise error